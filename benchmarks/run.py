@@ -0,0 +1,351 @@
+"""
+Нагрузочные сценарии основного сервиса на локальном стенде: заглушки
+микросервисов (stub_service) с настраиваемыми задержкой и долей ошибок и
+server.py, работающий с локальной MariaDB. Нужна отдельная пустая база:
+сценарии заполняют её своими группами, а опрос готовности проверяет все
+неготовые группы в ней. SQLite не подходит - Database использует
+MySQL-диалект (INSERT ... ON DUPLICATE KEY UPDATE, GET_LOCK).
+
+    docker run -d --name bench-db -p 3306:3306 -e MARIADB_ROOT_PASSWORD=bench \\
+        -e MARIADB_DATABASE=strawberry_bench mariadb:latest
+    python benchmarks/run.py --db-password bench
+    python benchmarks/run.py --db-password bench --scenario generate --stub-latency 0.2
+    python benchmarks/run.py --db-password bench --save-baseline
+
+Для каждого сценария печатаются p50/p99 задержки и запросов в секунду.
+Результаты сравниваются с benchmarks/baselines/<baseline>.json: если p99
+вырос или пропускная способность упала больше чем на --tolerance, скрипт
+завершается с кодом 1. --save-baseline перезаписывает этот файл.
+"""
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import random
+import subprocess
+import sys
+import time
+import httpx
+from signing import authorization_header
+from stand import MAIN_SRC, ROOT, Stand
+
+sys.path.insert(0, MAIN_SRC)
+
+from sqlalchemy.dialects.mysql import insert  # noqa: E402
+from config import Config  # noqa: E402
+from database import Database, AsyncDatabase  # noqa: E402
+from microservices import AsyncMicroserviceManager  # noqa: E402
+from poller import GroupStatusPoller  # noqa: E402
+
+
+BASELINES_DIR = os.path.join(ROOT, "benchmarks", "baselines")
+
+# disjoint group id ranges (the columns are signed INT), so scenarios
+# do not see each other's groups or real VK ids
+GENERATE_GROUPS = 1_000_000_000
+PAGINATION_GROUPS = 1_100_000_000
+ADD_GROUP_GROUPS = 1_200_000_000
+POLLER_GROUPS = 1_400_000_000
+
+# vk_user_id ranges for the same reason
+GENERATE_USERS = 2_000_000_000
+PAGINATION_USER = 2_100_000_000
+ADD_GROUP_USER = 2_100_000_001
+
+
+class ScenarioResult:
+    def __init__(self, name, latencies, errors, duration, units=None):
+        self.name = name
+        self.latencies = sorted(latencies)
+        self.errors = errors
+        self.duration = duration
+        # what "requests" means in rps, e.g. groups for the poller
+        self.units = len(latencies) if units is None else units
+
+    def percentile(self, q):
+        if not self.latencies:
+            return 0.0
+        index = min(len(self.latencies) - 1,
+                    int(round(q * (len(self.latencies) - 1))))
+        return self.latencies[index]
+
+    def summary(self):
+        return {
+            "requests": len(self.latencies),
+            "errors": self.errors,
+            "p50_ms": round(self.percentile(0.5) * 1000, 2),
+            "p99_ms": round(self.percentile(0.99) * 1000, 2),
+            "rps": round(self.units / self.duration, 1) if self.duration else 0.0,
+        }
+
+
+async def run_load(name, call, total, concurrency):
+    """
+    Выполняет total вызовов call(worker, i) не больше concurrency
+    одновременно. call возвращает True, если ответ успешный
+    """
+    latencies = []
+    errors = 0
+    counter = iter(range(total))
+
+    async def worker(worker_id):
+        nonlocal errors
+        for i in counter:
+            start = time.monotonic()
+            try:
+                ok = await call(worker_id, i)
+            except httpx.HTTPError:
+                ok = False
+            latencies.append(time.monotonic() - start)
+            if not ok:
+                errors += 1
+
+    start = time.monotonic()
+    await asyncio.gather(*[worker(worker_id) for worker_id in range(concurrency)])
+    return ScenarioResult(name, latencies, errors, time.monotonic() - start)
+
+
+def ok_status(response):
+    return response.status_code == 200 and response.json()["status"] == 0
+
+
+async def register_in_stubs(stand, group_ids, max_in_flight=200):
+    """Заглушки отвечают OK на /generate и /check_status только для известных им групп"""
+    semaphore = asyncio.Semaphore(max_in_flight)
+    async with httpx.AsyncClient(timeout=30) as client:
+        async def add(url, group_id):
+            async with semaphore:
+                await client.post(f"{url}/add_group", json={"group_id": group_id, "texts": []})
+        await asyncio.gather(*[add(url, group_id)
+                               for url in stand.stub_urls() for group_id in group_ids])
+
+
+def insert_groups(db, group_ids, status_id, vk_user_id=None, batch_size=5000):
+    """Заполнение таблиц пачками, минуя /add_group"""
+    with db.engine.begin() as connection:
+        for i in range(0, len(group_ids), batch_size):
+            batch = group_ids[i:i + batch_size]
+            insert_query = insert(db.vk_groups).values(
+                [{"group_id": group_id, "status_id": status_id} for group_id in batch])
+            connection.execute(insert_query.on_duplicate_key_update(
+                status_id=insert_query.inserted.status_id))
+        if vk_user_id is not None:
+            connection.execute(db._upsert_user_query(vk_user_id))
+            user_key = connection.execute(db.vk_user_ids.select().where(
+                db.vk_user_ids.c.vk_user_id == vk_user_id)).first().id
+            for i in range(0, len(group_ids), batch_size):
+                batch = group_ids[i:i + batch_size]
+                keys = connection.execute(db.vk_groups.select().where(
+                    db.vk_groups.c.group_id.in_(batch))).fetchall()
+                connection.execute(insert(db.id_group_link).prefix_with("IGNORE"),
+                                   [{"vk_user_id": user_key, "group_id": row.id} for row in keys])
+
+
+async def scenario_generate(stand, db, args):
+    group_ids = [GENERATE_GROUPS + i for i in range(args.groups)]
+    insert_groups(db, group_ids, status_id=0)
+    await register_in_stubs(stand, group_ids)
+    headers = [{"Authorization": authorization_header(GENERATE_USERS + i, stand.client_secret)}
+               for i in range(args.concurrency)]
+    services = stand.service_names()
+
+    async with httpx.AsyncClient(base_url=stand.base_url, timeout=120,
+                                 limits=httpx.Limits(max_connections=args.concurrency)) as client:
+        async def call(worker, i):
+            # unique hints, otherwise identical calls are coalesced
+            response = await client.post("/generate", headers=headers[worker], json={
+                "service_name": services[i % len(services)],
+                "group_id": random.choice(group_ids),
+                "hint": f"benchmark hint {i}"})
+            return ok_status(response)
+        return await run_load("generate", call, args.requests, args.concurrency)
+
+
+async def scenario_get_groups(stand, db, args):
+    group_ids = [PAGINATION_GROUPS + i for i in range(args.owned_groups)]
+    insert_groups(db, group_ids, status_id=1, vk_user_id=PAGINATION_USER)
+    headers = {"Authorization": authorization_header(
+        PAGINATION_USER, stand.client_secret)}
+    # every worker walks the whole list page by page with the after cursor
+    cursors = [None] * args.concurrency
+
+    async with httpx.AsyncClient(base_url=stand.base_url, timeout=60,
+                                 limits=httpx.Limits(max_connections=args.concurrency)) as client:
+        async def call(worker, i):
+            params = {"count": args.page_size}
+            if cursors[worker] is not None:
+                params["after"] = cursors[worker]
+            response = await client.get("/get_groups", headers=headers, params=params)
+            if not ok_status(response):
+                return False
+            cursors[worker] = response.json()["next_cursor"]
+            return True
+        return await run_load("get_groups", call, args.requests, args.concurrency)
+
+
+async def scenario_add_group(stand, db, args):
+    headers = {"Authorization": authorization_header(
+        ADD_GROUP_USER, stand.client_secret)}
+    # a fresh range of group ids on every run
+    run_id = int(time.time()) % 100_000
+    filler = "x" * max(0, args.text_length - 32)
+
+    async with httpx.AsyncClient(base_url=stand.base_url, timeout=300,
+                                 limits=httpx.Limits(max_connections=args.corpus_concurrency)) as client:
+        async def call(worker, i):
+            group_id = ADD_GROUP_GROUPS + run_id * 1000 + i
+            # distinct texts, stored corpora are deduplicated by content hash
+            texts = [f"{group_id} {n} {filler}" for n in range(args.texts)]
+            response = await client.post("/add_group", headers=headers,
+                                         json={"group_id": group_id, "texts": texts})
+            return ok_status(response)
+        return await run_load("add_group", call, args.corpus_requests, args.corpus_concurrency)
+
+
+async def scenario_check_statuses(stand, db, args):
+    """
+    Цикл опроса готовности в процессе бенчмарка против тех же заглушек и БД:
+    перед каждым циклом все poller_groups групп снова неготовы
+    """
+    group_ids = [POLLER_GROUPS + i for i in range(args.poller_groups)]
+    insert_groups(db, group_ids, status_id=1)
+    await register_in_stubs(stand, group_ids)
+
+    conf = Config(stand.config_path())
+    mmgr = AsyncMicroserviceManager(conf.services, conf.http_pool_size, conf.http_keepalive_size)
+    async_db = AsyncDatabase(db, workers=4)
+    latencies = []
+    errors = 0
+    checked = 0
+    try:
+        for _ in range(args.cycles):
+            await async_db.update_group_statuses({group_id: 1 for group_id in group_ids})
+            # a new poller has no backoff schedule, every group is checked
+            poller = GroupStatusPoller(async_db, mmgr, max_in_flight=conf.poller_max_in_flight)
+            stats = await poller.run_cycle()
+            latencies.append(stats.duration)
+            errors += stats.errors
+            checked += stats.checked
+    finally:
+        await mmgr.close()
+        async_db.executor.shutdown(wait=True)
+    # rps here is groups checked per second
+    return ScenarioResult("check_statuses", latencies, errors, sum(latencies), units=checked)
+
+
+SCENARIOS = {
+    "generate": scenario_generate,
+    "get_groups": scenario_get_groups,
+    "add_group": scenario_add_group,
+    "check_statuses": scenario_check_statuses,
+}
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                       text=True, stderr=subprocess.DEVNULL).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return ""
+
+
+def compare(results, baseline, tolerance):
+    """Возвращает список регрессий относительно сохранённых результатов"""
+    regressions = []
+    for name, current in results.items():
+        previous = baseline.get("results", {}).get(name)
+        if previous is None:
+            continue
+        if previous["p99_ms"] and current["p99_ms"] > previous["p99_ms"] * (1 + tolerance):
+            regressions.append(
+                f"{name}: p99 {previous['p99_ms']}ms -> {current['p99_ms']}ms")
+        if previous["rps"] and current["rps"] < previous["rps"] * (1 - tolerance):
+            regressions.append(
+                f"{name}: rps {previous['rps']} -> {current['rps']}")
+    return regressions
+
+
+def baseline_params(args):
+    """Параметры прогона для файла с базовыми результатами, без адреса и учётных данных БД"""
+    return {key: value for key, value in vars(args).items()
+            if not key.startswith("db_")}
+
+
+async def run(args):
+    db_params = {"user": args.db_user, "password": args.db_password, "host": args.db_host,
+                 "port": args.db_port, "database": args.db_name}
+    stand = Stand(db_params, services=args.services, main_port=args.main_port, stub_port=args.stub_port,
+                  workers=args.workers, stub_latency=args.stub_latency, stub_jitter=args.stub_jitter,
+                  stub_failure_rate=args.stub_failure_rate)
+    db = Database(args.db_user, args.db_password, args.db_name, args.db_port, args.db_host)
+    results = {}
+    with stand:
+        for name in args.scenario or list(SCENARIOS):
+            result = await SCENARIOS[name](stand, db, args)
+            results[name] = result.summary()
+            print(f"{name:16} {json.dumps(results[name])}", flush=True)
+    db.dispose()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scenario", action="append", choices=list(SCENARIOS),
+                        help="по умолчанию все сценарии")
+    parser.add_argument("--db-host", default="127.0.0.1")
+    parser.add_argument("--db-port", type=int, default=3306)
+    parser.add_argument("--db-user", default="root")
+    parser.add_argument("--db-password", default="")
+    parser.add_argument("--db-name", default="strawberry_bench")
+    parser.add_argument("--main-port", type=int, default=14565)
+    parser.add_argument("--stub-port", type=int, default=15000)
+    parser.add_argument("--workers", type=int, default=1,
+                        help="воркеры uvicorn основного сервиса")
+    parser.add_argument("--services", type=int, default=2,
+                        help="количество заглушек микросервисов")
+    parser.add_argument("--stub-latency", type=float, default=0.05)
+    parser.add_argument("--stub-jitter", type=float, default=0.05)
+    parser.add_argument("--stub-failure-rate", type=float, default=0.0)
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--groups", type=int, default=100,
+                        help="готовые группы для /generate")
+    parser.add_argument("--owned-groups", type=int, default=5000,
+                        help="группы пользователя для /get_groups")
+    parser.add_argument("--page-size", type=int, default=50)
+    parser.add_argument("--corpus-requests", type=int, default=20)
+    parser.add_argument("--corpus-concurrency", type=int, default=4)
+    parser.add_argument("--texts", type=int, default=5000,
+                        help="тексты в одном /add_group")
+    parser.add_argument("--text-length", type=int, default=500)
+    parser.add_argument("--poller-groups", type=int, default=10000)
+    parser.add_argument("--cycles", type=int, default=5)
+    parser.add_argument("--baseline", default="local")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+
+    path = os.path.join(BASELINES_DIR, f"{args.baseline}.json")
+    if args.save_baseline:
+        with open(path, "w", encoding="UTF-8") as file:
+            json.dump({"revision": git_revision(), "date": datetime.date.today().isoformat(),
+                       "params": baseline_params(args), "results": results}, file, indent=4, sort_keys=True)
+            file.write("\n")
+        print(f"Baseline saved to {path}")
+        return
+    if not os.path.exists(path):
+        print(f"No baseline at {path}, run with --save-baseline to create it")
+        return
+    with open(path, "r", encoding="UTF-8") as file:
+        regressions = compare(results, json.load(file), args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,134 @@
+"""
+Локальный стенд: заглушки микросервисов из stub_service и server.py
+основного сервиса, каждый в своём процессе uvicorn, и конфиг для них
+"""
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import httpx
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+MAIN_SRC = os.path.join(ROOT, "main_service", "src")
+STUB_SRC = os.path.join(ROOT, "stub_service", "src")
+
+
+class Stand:
+    """
+    Поднимает services заглушек (порты с stub_port), затем основной сервис на
+    main_port с конфигом, в котором лимиты запросов не мешают нагрузке.
+    Используется как контекстный менеджер, процессы останавливаются на выходе
+    """
+
+    def __init__(self, db, services=1, main_port=14565, stub_port=15000, workers=1,
+                 stub_latency=0.0, stub_jitter=0.0, stub_failure_rate=0.0, stub_token_delay=0.0,
+                 client_secret="benchmark", internal_secret="benchmark"):
+        self.db = db
+        self.services = services
+        self.main_port = main_port
+        self.stub_port = stub_port
+        self.workers = workers
+        self.stub_env = {
+            "STUB_TRAIN_SECONDS": "0",
+            "STUB_LATENCY": str(stub_latency),
+            "STUB_LATENCY_JITTER": str(stub_jitter),
+            "STUB_FAILURE_RATE": str(stub_failure_rate),
+            "STUB_TOKEN_DELAY": str(stub_token_delay),
+        }
+        self.client_secret = client_secret
+        self.internal_secret = internal_secret
+        self.workdir = tempfile.mkdtemp(prefix="strawberry_bench_")
+        self.processes = []
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.main_port}"
+
+    def stub_urls(self):
+        return [f"http://127.0.0.1:{self.stub_port + i}" for i in range(self.services)]
+
+    def service_names(self):
+        return [f"stub{i}" for i in range(self.services)]
+
+    def config(self):
+        services = [{name: {"docker_name": name, "url": "http://127.0.0.1", "port": self.stub_port + i,
+                            "max_inflight": 1024, "max_waiting": 4096, "queue_size": 10000}}
+                    for i, name in enumerate(self.service_names())]
+        return {
+            "client_secret": self.client_secret,
+            "internal_secret": self.internal_secret,
+            "db_user": self.db["user"],
+            "db_password": self.db["password"],
+            "db_host": self.db["host"],
+            "db_port": self.db["port"],
+            "db_db": self.db["database"],
+            "services": services,
+            "poller_mode": "external",
+            "user_rate_limit": 1000000,
+            "user_rate_burst": 1000000,
+            "log_dir": self.workdir,
+            "log_level": "WARNING",
+        }
+
+    def config_path(self):
+        path = os.path.join(self.workdir, "config.json")
+        with open(path, "w", encoding="UTF-8") as file:
+            json.dump(self.config(), file)
+        return path
+
+    def _spawn(self, app_dir, port, env, workers=1):
+        log = open(os.path.join(self.workdir, f"uvicorn_{port}.txt"),
+                   "w", encoding="UTF-8")
+        process = subprocess.Popen(
+            [sys.executable, "-m", "uvicorn", "--app-dir", app_dir, "--host", "127.0.0.1",
+             "--port", str(port), "--workers", str(workers), "--log-level", "warning", "server:app"],
+            env={**os.environ, **env}, stdout=log, stderr=subprocess.STDOUT)
+        self.processes.append((process, log))
+
+    def start(self):
+        for i, name in enumerate(self.service_names()):
+            self._spawn(STUB_SRC, self.stub_port + i,
+                        {**self.stub_env, "STUB_SERVICE_NAME": name})
+        self._spawn(MAIN_SRC, self.main_port,
+                    {"STRAWBERRY_CONFIG": self.config_path()}, self.workers)
+        for url in self.stub_urls():
+            wait_ready(f"{url}/health")
+        wait_ready(f"{self.base_url}/metrics")
+
+    def stop(self):
+        for process, log in self.processes:
+            process.terminate()
+        for process, log in self.processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            log.close()
+        self.processes = []
+
+    def __enter__(self):
+        try:
+            self.start()
+        except Exception:
+            self.stop()
+            raise
+        return self
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+def wait_ready(url, timeout=60):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            if httpx.get(url, timeout=1).status_code < 500:
+                return
+        except httpx.HTTPError:
+            pass
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"{url} did not come up in {timeout}s")
+        time.sleep(0.2)
@@ -0,0 +1,80 @@
+import logging
+import time
+
+
+class Replica:
+    def __init__(self, url, port):
+        self.base_url = f"{url}:{port}"
+        self.outstanding = 0
+        self.ewma_latency = 0.0
+        self.failures = 0
+        self.ejected_until = 0.0
+        # the replica has not received the whole stored corpus yet
+        self.catching_up = False
+
+    def available(self, now):
+        return self.ejected_until <= now
+
+
+class ReplicaPool:
+    """
+    Реплики одного сервиса. pick выбирает реплику с наименьшим числом
+    незавершённых запросов, при равенстве - с наименьшей EWMA задержки.
+    После failure_threshold ошибок подряд (или неудачной проверки здоровья)
+    реплика исключается на eject_seconds секунд, проверки здоровья этот срок
+    не сокращают. Успешная проверка доступной реплики сбрасывает счётчик
+    ошибок, иначе после исключения реплику снова исключит первая же ошибка.
+    Реплики, которые ещё догоняют корпус (catching_up), получают генерацию,
+    только если других доступных нет
+    """
+
+    EWMA_ALPHA = 0.3
+
+    def __init__(self, name, replicas, failure_threshold=5, eject_seconds=30):
+        self.name = name
+        self.replicas = replicas
+        self.failure_threshold = failure_threshold
+        self.eject_seconds = eject_seconds
+
+    def available(self):
+        now = time.monotonic()
+        return [replica for replica in self.replicas if replica.available(now)]
+
+    def pick(self):
+        available = self.available()
+        if not available:
+            return None
+        available = [replica for replica in available
+                     if not replica.catching_up] or available
+        return min(available, key=lambda replica: (replica.outstanding, replica.ewma_latency))
+
+    def started(self, replica):
+        replica.outstanding += 1
+
+    def finished(self, replica, latency, ok):
+        replica.outstanding -= 1
+        if ok:
+            replica.failures = 0
+            replica.ewma_latency = latency if replica.ewma_latency == 0 else \
+                self.EWMA_ALPHA * latency + \
+                (1 - self.EWMA_ALPHA) * replica.ewma_latency
+            return
+        replica.failures += 1
+        if replica.failures >= self.failure_threshold and replica.available(time.monotonic()):
+            self._eject(replica, f"{replica.failures} failures in a row")
+
+    def report_health(self, replica, healthy):
+        if not replica.available(time.monotonic()):
+            # an ejection always lasts eject_seconds
+            return
+        if not healthy:
+            self._eject(replica, "health check failed")
+        elif replica.failures:
+            logging.info(
+                f"Replica {replica.base_url} of {self.name} is healthy again")
+            replica.failures = 0
+
+    def _eject(self, replica, reason):
+        replica.ejected_until = time.monotonic() + self.eject_seconds
+        logging.error(
+            f"Replica {replica.base_url} of {self.name} ejected for {self.eject_seconds}s: {reason}")
@@ -0,0 +1,132 @@
+import asyncio
+import time
+from collections import OrderedDict
+
+
+class TTLCache:
+    """
+    Ограниченный по размеру LRU-кэш, записи которого устаревают через ttl
+    секунд (ttl=None - не устаревают). Не потокобезопасен: используется
+    только из event loop
+    """
+
+    def __init__(self, max_size, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        # key -> (expires_at, value)
+        self.data = OrderedDict()
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return self.get(key, _MISSING) is not _MISSING
+
+    def get(self, key, default=None):
+        entry = self.data.get(key)
+        if entry is None:
+            return default
+        if entry[0] is not None and entry[0] <= time.monotonic():
+            del self.data[key]
+            return default
+        self.data.move_to_end(key)
+        return entry[1]
+
+    def set(self, key, value):
+        expires_at = None if self.ttl is None else time.monotonic() + self.ttl
+        self.data[key] = (expires_at, value)
+        self.data.move_to_end(key)
+        while len(self.data) > self.max_size:
+            self.data.popitem(last=False)
+
+    def pop(self, key, default=None):
+        entry = self.data.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self):
+        self.data.clear()
+
+
+class GroupStatusCache:
+    """
+    Статусы групп в памяти процесса. Готовые группы (0) хранятся, пока не
+    вытеснены, неготовые (1) - не дольше not_ready_ttl секунд, потому что
+    статус может поменять другой воркер. Промах читает статус из БД
+    """
+
+    def __init__(self, db, max_size=100000, not_ready_ttl=10):
+        self.db = db
+        self.ready = TTLCache(max_size)
+        self.not_ready = TTLCache(max_size, not_ready_ttl)
+
+    def set(self, group_id, status):
+        if status == 0:
+            self.ready.set(group_id, True)
+            self.not_ready.pop(group_id)
+        elif status == 1:
+            self.not_ready.set(group_id, True)
+            self.ready.pop(group_id)
+        else:
+            self.forget(group_id)
+
+    def forget(self, group_id):
+        self.ready.pop(group_id)
+        self.not_ready.pop(group_id)
+
+    def cached(self, group_id):
+        """Статус из памяти или None"""
+        if group_id in self.ready:
+            return 0
+        if group_id in self.not_ready:
+            return 1
+        return None
+
+    async def get(self, group_id):
+        status = self.cached(group_id)
+        if status is None:
+            status = await self.db.get_group_status(group_id)
+            self.set(group_id, status)
+        return status
+
+    async def get_many(self, group_ids):
+        """Статусы нескольких групп, все промахи читаются из БД одним запросом"""
+        statuses = {group_id: self.cached(group_id) for group_id in group_ids}
+        missing = [group_id for group_id, status in statuses.items()
+                   if status is None]
+        if missing:
+            for group_id, status in (await self.db.get_group_statuses(missing)).items():
+                self.set(group_id, status)
+                statuses[group_id] = status
+        return statuses
+
+
+class SingleFlight:
+    """
+    Объединяет одновременные вызовы с одинаковым ключом: первый вызов
+    выполняет factory(), остальные ждут его результат. Вызов доводится до
+    конца, даже если первый ожидающий отменён
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = 0
+
+    def _done(self, key, future):
+        if self.calls.get(key) is future:
+            del self.calls[key]
+        if not future.cancelled():
+            # mark the exception as retrieved when nobody is waiting anymore
+            future.exception()
+
+    async def do(self, key, factory):
+        future = self.calls.get(key)
+        if future is None:
+            future = asyncio.ensure_future(factory())
+            self.calls[key] = future
+            future.add_done_callback(lambda f: self._done(key, f))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(future)
+
+
+_MISSING = object()
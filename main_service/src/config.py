@@ -8,6 +8,20 @@ class MicroserviceData:
         self.docker_name = dict_data["docker_name"]
         self.port = dict_data["port"]
         self.url = dict_data["url"]
+        # [{"url": ..., "port": ...}], defaults to the single url:port above
+        self.replicas = dict_data.get(
+            "replicas", [{"url": self.url, "port": self.port}])
+        # false for services whose output must differ between identical calls
+        self.cache_results = dict_data.get("cache_results", True)
+        # generation job queue limits
+        self.max_concurrency = dict_data.get("max_concurrency", 4)
+        self.queue_size = dict_data.get("queue_size", 100)
+        # admission control for synchronous generation, rate_limit in
+        # requests per second (None - unlimited)
+        self.rate_limit = dict_data.get("rate_limit", None)
+        self.rate_burst = dict_data.get("rate_burst", 10)
+        self.max_inflight = dict_data.get("max_inflight", 16)
+        self.max_waiting = dict_data.get("max_waiting", 32)
 
 
 class Config:
@@ -21,5 +35,73 @@ class Config:
             self.db_port = self.raw_data["db_port"]
             self.db_host = self.raw_data["db_host"]
             self.db_db = self.raw_data["db_db"]
+            self.db_pool_size = self.raw_data.get("db_pool_size", 10)
+            self.db_max_overflow = self.raw_data.get("db_max_overflow", 20)
+            self.db_pool_recycle = self.raw_data.get("db_pool_recycle", 3600)
+            self.db_pool_pre_ping = self.raw_data.get("db_pool_pre_ping", True)
+            self.db_executor_workers = self.raw_data.get(
+                "db_executor_workers", self.db_pool_size + self.db_max_overflow)
+            # [{"host": ..., "port": ...}], same user/password/db as the primary
+            self.db_replicas = self.raw_data.get("db_replicas", [])
+            self.db_replica_policy = self.raw_data.get(
+                "db_replica_policy", "round_robin")
+            # keys written by this process are read from the primary for this
+            # many seconds; the map is per process, so reads that must see
+            # writes made through other workers (owned groups, unknown group
+            # ids) go to the primary regardless of it
+            self.db_read_your_writes_window = self.raw_data.get(
+                "db_read_your_writes_window", 5)
             self.services = [MicroserviceData(data)
                              for data in self.raw_data["services"]]
+            self.http_pool_size = self.raw_data.get("http_pool_size", 100)
+            self.http_keepalive_size = self.raw_data.get(
+                "http_keepalive_size", 20)
+            # leader - one worker runs the poller (MariaDB named lock),
+            # external - the poller runs as poller_main.py, every - every worker polls
+            self.poller_mode = self.raw_data.get("poller_mode", "leader")
+            self.poller_interval = self.raw_data.get("poller_interval", 10)
+            self.poller_max_in_flight = self.raw_data.get(
+                "poller_max_in_flight", 50)
+            self.poller_max_backoff = self.raw_data.get(
+                "poller_max_backoff", 300)
+            # how many failed group ids one poll cycle writes to the log
+            self.poller_log_sample = self.raw_data.get("poller_log_sample", 10)
+            self.replica_failure_threshold = self.raw_data.get(
+                "replica_failure_threshold", 5)
+            self.replica_eject_seconds = self.raw_data.get(
+                "replica_eject_seconds", 30)
+            self.health_check_interval = self.raw_data.get(
+                "health_check_interval", 10)
+            self.internal_secret = self.raw_data.get("internal_secret", "")
+            # how far X-Timestamp of a signed GET /internal/stats may be from now, seconds
+            self.internal_signature_window = self.raw_data.get(
+                "internal_signature_window", 30)
+            self.user_rate_limit = self.raw_data.get("user_rate_limit", 1)
+            self.user_rate_burst = self.raw_data.get("user_rate_burst", 5)
+            self.admission_wait_timeout = self.raw_data.get(
+                "admission_wait_timeout", 2)
+            self.auth_cache_size = self.raw_data.get("auth_cache_size", 10000)
+            self.auth_cache_ttl = self.raw_data.get("auth_cache_ttl", 600)
+            self.known_users_cache_size = self.raw_data.get(
+                "known_users_cache_size", 100000)
+            self.group_status_cache_size = self.raw_data.get(
+                "group_status_cache_size", 100000)
+            self.group_status_not_ready_ttl = self.raw_data.get(
+                "group_status_not_ready_ttl", 10)
+            # 0 disables the cache of generation results
+            self.generate_cache_size = self.raw_data.get(
+                "generate_cache_size", 1000)
+            self.generate_cache_ttl = self.raw_data.get(
+                "generate_cache_ttl", 0)
+            # item limits of /get_group_statuses and /generate_batch; a batch
+            # takes a user rate limit token per item, so a /generate_batch
+            # larger than user_rate_burst could never be admitted
+            self.batch_max_groups = self.raw_data.get("batch_max_groups", 1000)
+            self.batch_max_generate = self.raw_data.get(
+                "batch_max_generate", self.user_rate_burst)
+            self.log_dir = self.raw_data.get("log_dir", "/home/logs")
+            self.log_level = self.raw_data.get("log_level", "INFO")
+            self.log_max_bytes = self.raw_data.get("log_max_bytes", 50 << 20)
+            self.log_backup_count = self.raw_data.get("log_backup_count", 5)
+            self.log_max_field_length = self.raw_data.get(
+                "log_max_field_length", 256)
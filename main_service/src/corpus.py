@@ -0,0 +1,175 @@
+import asyncio
+import hashlib
+import logging
+from collections import defaultdict
+from database import DBException
+from microservices import ChunksNotSupported, MicroserviceException
+
+
+class CorpusStore:
+    """
+    Хранит тексты групп в БД (без повторов по sha256) и помнит для каждой
+    реплики каждого сервиса, до какого текста корпус группы уже доставлен. sync_group
+    отправляет сервису только недоставленные тексты через /add_group_chunk,
+    поэтому новый сервис получает весь сохранённый корпус, а повторное
+    добавление группы - только новые посты. Сервис должен дописывать их к уже
+    полученным текстам группы, протокол частей описан в
+    AsyncMicroserviceManager.send_group_chunks. Сервису без /add_group_chunk
+    при появлении новых текстов весь корпус отправляется одним /add_group.
+    Реплики, впервые увиденные воркером или вернувшиеся после исключения,
+    догоняют корпуса всех групп в фоне (start_catch_up), до этого генерация
+    уходит в другие реплики
+    """
+
+    PAGE_SIZE = 500
+    STORE_BATCH_SIZE = 500
+
+    def __init__(self, db, mmgr):
+        self.db = db
+        self.mmgr = mmgr
+        self.catch_up_task = None
+
+    async def store(self, group_id, texts):
+        for i in range(0, len(texts), self.STORE_BATCH_SIZE):
+            await self.db.store_group_texts(group_id, texts[i:i + self.STORE_BATCH_SIZE])
+
+    async def sync_group(self, group_id, service_names=None):
+        """Досылает сервисам недоставленные тексты группы, возвращает {service_name: количество текстов}"""
+        if service_names is None:
+            service_names = [service.docker_name for service in self.mmgr.services]
+        watermarks = await self.db.get_delivery_watermarks(group_id)
+        sent = await asyncio.gather(*[self._sync_service(service_name, group_id, watermarks)
+                                      for service_name in service_names])
+        return dict(zip(service_names, sent))
+
+    async def replay_replica(self, service_name, replica_url, group_id):
+        """Отправляет весь корпус группы в одну реплику сервиса, например только что развёрнутую"""
+        return await self._deliver(service_name, group_id, 0, [replica_url])
+
+    def start_catch_up(self, interval):
+        if self.catch_up_task is None:
+            self.catch_up_task = asyncio.create_task(
+                self._catch_up_loop(interval))
+
+    async def stop_catch_up(self):
+        if self.catch_up_task is not None:
+            self.catch_up_task.cancel()
+            await asyncio.gather(self.catch_up_task, return_exceptions=True)
+            self.catch_up_task = None
+
+    async def catch_up_replica(self, service_name, replica_url):
+        """
+        Досылает реплике все тексты, которые она пропустила. Пока они есть,
+        реплика помечена catching_up. Возвращает True, если реплика догнала
+        корпус, и False, если её сейчас догоняет другой воркер
+        """
+        lagging = await self.db.get_lagging_groups(service_name, replica_url)
+        self.mmgr.set_catching_up(service_name, replica_url, bool(lagging))
+        if not lagging:
+            return True
+        # MariaDB lock names are limited to 64 characters
+        lock_name = "corpus_catch_up_" + \
+            hashlib.sha1(f"{service_name} {replica_url}".encode()).hexdigest()
+        if not await self.db.try_acquire_lock(lock_name):
+            return False
+        try:
+            logging.info(
+                f"Replica {replica_url} of {service_name} is catching up on {len(lagging)} groups")
+            for group_id, after_id in lagging.items():
+                await self._deliver(service_name, group_id, after_id, [replica_url])
+        finally:
+            await self.db.release_lock(lock_name)
+        self.mmgr.set_catching_up(service_name, replica_url, False)
+        return True
+
+    async def _catch_up_loop(self, interval):
+        # every replica is checked once when first seen and again each time
+        # it comes back from ejection, until it has the whole corpus
+        behind = {(service.docker_name, url) for service in self.mmgr.services
+                  for url in self.mmgr.replica_urls(service.docker_name)}
+        while True:
+            for service in self.mmgr.services:
+                service_name = service.docker_name
+                available = set(self.mmgr.replica_urls(service_name, available_only=True))
+                for url in self.mmgr.replica_urls(service_name):
+                    if url not in available:
+                        behind.add((service_name, url))
+                    elif (service_name, url) in behind:
+                        try:
+                            if await self.catch_up_replica(service_name, url):
+                                behind.discard((service_name, url))
+                        except (DBException, MicroserviceException) as exc:
+                            logging.error(
+                                f"Cannot catch up replica {url} of {service_name}: {exc}")
+            await asyncio.sleep(interval)
+
+    async def _sync_service(self, service_name, group_id, watermarks):
+        # replicas are tracked separately: one that is ejected now catches up
+        # in _catch_up_loop once it is back
+        urls = self.mmgr.replica_urls(service_name, available_only=True)
+        if not urls:
+            raise MicroserviceException(
+                f"No available replicas of microservice {service_name}")
+        skipped = set(self.mmgr.replica_urls(service_name)) - set(urls)
+        if skipped:
+            logging.warning(
+                f"group: {group_id};\tunavailable replicas of {service_name} catch up later: {sorted(skipped)}")
+
+        # replicas at the same watermark share one read of the corpus
+        by_watermark = defaultdict(list)
+        for url in urls:
+            after_id = watermarks.get((service_name, url),
+                                      watermarks.get((service_name, ""), 0))
+            by_watermark[after_id].append(url)
+        sent = await asyncio.gather(*[self._deliver(service_name, group_id, after_id, replica_urls)
+                                      for after_id, replica_urls in by_watermark.items()])
+        return max(sent)
+
+    async def _deliver(self, service_name, group_id, after_id, replica_urls):
+        if self.mmgr.supports_chunks(service_name):
+            try:
+                return await self._deliver_chunks(service_name, group_id, after_id, replica_urls)
+            except ChunksNotSupported:
+                logging.info(
+                    f"Microservice {service_name} has no /add_group_chunk, sending whole corpora by /add_group")
+        return await self._deliver_whole(service_name, group_id, after_id, replica_urls)
+
+    async def _deliver_chunks(self, service_name, group_id, after_id, replica_urls):
+        page = await self.db.get_group_texts_after(group_id, after_id, self.PAGE_SIZE)
+        if not page:
+            return 0
+        last_id = after_id
+        sent = 0
+
+        async def chunks():
+            nonlocal page, last_id, sent
+            while page:
+                last_id = page[-1][0]
+                sent += len(page)
+                yield [text for _, text in page]
+                if len(page) < self.PAGE_SIZE:
+                    return
+                page = await self.db.get_group_texts_after(group_id, last_id, self.PAGE_SIZE)
+
+        await self.mmgr.send_group_chunks(service_name, group_id, chunks(), replica_urls)
+        # only after every replica accepted the last chunk
+        for url in replica_urls:
+            await self.db.set_delivery_watermark(service_name, url, group_id, last_id)
+        return sent
+
+    async def _deliver_whole(self, service_name, group_id, after_id, replica_urls):
+        # /add_group replaces the corpus of the group, so it always gets all
+        # stored texts, but only when there is something new after after_id
+        if not await self.db.get_group_texts_after(group_id, after_id, 1):
+            return 0
+        rows = []
+        page = await self.db.get_group_texts_after(group_id, 0, self.PAGE_SIZE)
+        while page:
+            rows.extend(page)
+            if len(page) < self.PAGE_SIZE:
+                break
+            page = await self.db.get_group_texts_after(group_id, page[-1][0], self.PAGE_SIZE)
+        await self.mmgr.send_group_corpus(service_name, group_id, [text for _, text in rows], replica_urls)
+        for url in replica_urls:
+            await self.db.set_delivery_watermark(service_name, url, group_id, rows[-1][0])
+        return len(rows)
@@ -1,6 +1,17 @@
+import asyncio
 import datetime
-from sqlalchemy import create_engine, Table, Column, Integer, DateTime, MetaData, ForeignKey, inspect, select, update, insert
-from models import GroupAndStatusModel
+import functools
+import hashlib
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text, create_engine, Table, Column, Integer, BigInteger, String, Text, DateTime, MetaData, ForeignKey, Index, UniqueConstraint, select, update, delete, case, func, and_
+from sqlalchemy.dialects.mysql import insert
+from models import GroupAndStatusModel, JobResultModel
+from migrations import run_migrations
+import metrics
+import tracing
 
 
 class DBException(Exception):
@@ -9,9 +20,32 @@ class DBException(Exception):
 
 class Database():
 
-    def __init__(self, user, password, database, port, host):
+    STICKY_PRUNE_SIZE = 10000
+
+    def __init__(self, user, password, database, port, host,
+                 pool_size=10, max_overflow=20, pool_recycle=3600, pool_pre_ping=True,
+                 replicas=None, replica_policy="round_robin", read_your_writes_window=5):
         self.database_uri = f"mysql+pymysql://{user}:{password}@{host}:{port}/{database}?charset=utf8mb4"
-        self.engine = create_engine(self.database_uri)
+        engine_options = {"pool_size": pool_size, "max_overflow": max_overflow,
+                          "pool_recycle": pool_recycle, "pool_pre_ping": pool_pre_ping}
+        self.engine = create_engine(self.database_uri, **engine_options)
+
+        # Reads go to replicas (if any), writes always go to self.engine.
+        # Keys written during the last read_your_writes_window seconds are
+        # read from the primary so that a user sees their own changes
+        self.read_engines = [create_engine(
+            f"mysql+pymysql://{user}:{password}@{replica['host']}:{replica['port']}/{database}?charset=utf8mb4",
+            **engine_options) for replica in (replicas or [])]
+        if replica_policy not in ("round_robin", "least_busy"):
+            raise DBException(f"Unknown replica policy: {replica_policy}")
+        self.replica_policy = replica_policy
+        self.replica_counter = itertools.count()
+        self.read_your_writes_window = read_your_writes_window
+        # (kind, id) -> monotonic deadline of reading it from the primary
+        self.sticky = {}
+        self.sticky_lock = threading.Lock()
+        # lock name -> connection holding the MariaDB named lock
+        self.lock_connections = {}
 
         self.meta = MetaData()
 
@@ -22,6 +56,7 @@ class Database():
             Column("vk_user_id", Integer, nullable=False),
             Column("acquired", DateTime(timezone=True),
                    default=datetime.datetime.utcnow, nullable=False),
+            UniqueConstraint("vk_user_id", name="ux_vk_user_ids_vk_user_id"),
         )
 
         self.vk_groups = Table(
@@ -31,6 +66,8 @@ class Database():
             Column("group_id", Integer, nullable=False),
             Column("status_id", Integer, nullable=False),
             # 0:ready, 1:not_ready
+            UniqueConstraint("group_id", name="ux_vk_groups_group_id"),
+            Index("ix_vk_groups_status_id", "status_id"),
         )
 
         self.id_group_link = Table(
@@ -40,34 +77,109 @@ class Database():
                 "vk_user_ids.id"), nullable=False),
             Column("group_id", Integer, ForeignKey(
                 "vk_groups.id"), nullable=False),
+            UniqueConstraint("vk_user_id", "group_id",
+                             name="ux_id_group_link"),
         )
 
-    def tables_exist(self):
-        try:
-            if (not inspect(self.engine).has_table("vk_user_ids")) or (not inspect(self.engine).has_table("vk_groups")) or (not inspect(self.engine).has_table("id_group_link")):
-                return False
-            return True
-        except Exception as exc:
-            raise DBException(f"Error in tables_exist: {exc}") from exc
+        self.generation_jobs = Table(
+            "generation_jobs",
+            self.meta,
+            Column("id", Integer, primary_key=True, nullable=False),
+            Column("job_id", String(32), nullable=False),
+            Column("vk_user_id", Integer, nullable=False),
+            Column("service_name", String(255), nullable=False),
+            Column("group_id", Integer, nullable=False),
+            Column("hint", Text, nullable=False),
+            Column("job_status", Integer, nullable=False),
+            # 0:queued, 1:running, 2:done, 3:failed
+            Column("result_status", Integer, nullable=False),
+            Column("result", Text, nullable=False),
+            Column("created", DateTime, nullable=False),
+            Column("updated", DateTime, nullable=False),
+            UniqueConstraint("job_id", name="ux_generation_jobs_job_id"),
+            Index("ix_generation_jobs_job_status", "job_status", "updated"),
+        )
+
+        self.group_texts = Table(
+            "group_texts",
+            self.meta,
+            Column("id", BigInteger, primary_key=True, nullable=False),
+            Column("group_id", Integer, nullable=False),
+            Column("text_hash", String(64), nullable=False),
+            # sha256 of the utf-8 text
+            Column("text", Text, nullable=False),
+            UniqueConstraint("group_id", "text_hash",
+                             name="ux_group_texts_group_id_text_hash"),
+            Index("ix_group_texts_group_id_id", "group_id", "id"),
+        )
+
+        self.corpus_deliveries = Table(
+            "corpus_deliveries",
+            self.meta,
+            Column("service_name", String(255),
+                   primary_key=True, nullable=False),
+            # '' - delivered to the whole service (rows from before migration 5)
+            Column("replica_url", String(255), primary_key=True,
+                   nullable=False, server_default=""),
+            Column("group_id", Integer, primary_key=True, nullable=False),
+            Column("last_text_id", BigInteger, nullable=False),
+            # every group_texts row with id <= last_text_id was delivered
+            Column("updated", DateTime, nullable=False),
+        )
+
+    def _mark_written(self, *keys):
+        # called from AsyncDatabase executor threads
+        deadline = time.monotonic() + self.read_your_writes_window
+        with self.sticky_lock:
+            if len(self.sticky) > self.STICKY_PRUNE_SIZE:
+                now = time.monotonic()
+                self.sticky = {key: until for key,
+                               until in self.sticky.items() if until > now}
+            for key in keys:
+                self.sticky[key] = deadline
+
+    def _read_engine(self, *keys, primary=False):
+        if primary or not self.read_engines:
+            return self.engine
+        now = time.monotonic()
+        with self.sticky_lock:
+            sticky = any(self.sticky.get(key, 0) > now for key in keys)
+        if sticky:
+            return self.engine
+        if self.replica_policy == "least_busy":
+            return min(self.read_engines, key=lambda engine: engine.pool.checkedout())
+        return self.read_engines[next(self.replica_counter) % len(self.read_engines)]
+
+    def dispose(self):
+        for lock_name in list(self.lock_connections):
+            self.release_lock(lock_name)
+        self.engine.dispose()
+        for engine in self.read_engines:
+            engine.dispose()
 
     def migrate(self):
+        # Schema lives in migrations.MIGRATIONS, the tables above mirror it
         try:
-            self.meta.create_all(self.engine)
+            return run_migrations(self.engine)
         except Exception as exc:
             raise DBException(f"Error in migrate: {exc}") from exc
 
+    def _upsert_user_query(self, vk_user_id):
+        insert_query = insert(self.vk_user_ids).values(vk_user_id=vk_user_id)
+        return insert_query.on_duplicate_key_update(
+            vk_user_id=insert_query.inserted.vk_user_id)
+
     def add_user_id(self, vk_user_id):
         try:
             with self.engine.connect() as connection:
-                insert_query = insert(self.vk_user_ids).values(
-                    vk_user_id=vk_user_id)
-                connection.execute(insert_query)
+                connection.execute(self._upsert_user_query(vk_user_id))
+            self._mark_written(("user", vk_user_id))
         except Exception as exc:
             raise DBException(f"Error in add_user_id: {exc}") from exc
 
-    def is_valid_user_id(self, vk_user_id):
+    def is_valid_user_id(self, vk_user_id, primary=False):
         try:
-            with self.engine.connect() as connection:
+            with self._read_engine(("user", vk_user_id), primary=primary).connect() as connection:
                 select_query = select(self.vk_user_ids).where(
                     self.vk_user_ids.c.vk_user_id == vk_user_id)
                 result = connection.execute(select_query).fetchall()
@@ -77,33 +189,39 @@ class Database():
         except Exception as exc:
             raise DBException(f"Error in is_valid_user_id: {exc}") from exc
 
+    def get_recent_user_ids(self, limit, primary=False):
+        try:
+            with self._read_engine(primary=primary).connect() as connection:
+                select_query = select(self.vk_user_ids.c.vk_user_id).order_by(
+                    self.vk_user_ids.c.id.desc()).limit(limit)
+                result = connection.execute(select_query).fetchall()
+                return [row[0] for row in result]
+        except Exception as exc:
+            raise DBException(f"Error in get_recent_user_ids: {exc}") from exc
+
     def add_group(self, group_id, vk_user_id):
         try:
-            with self.engine.connect() as connection:
+            with self.engine.begin() as connection:
+                connection.execute(self._upsert_user_query(vk_user_id))
 
-                select_group_count_query = select(self.vk_groups.c.id).where(
-                    self.vk_groups.c.group_id == group_id)
-                count = len(connection.execute(
-                    select_group_count_query).fetchall())
+                # an existing group keeps its status
+                insert_group_query = insert(self.vk_groups).values(
+                    group_id=group_id, status_id=1)
+                connection.execute(insert_group_query.on_duplicate_key_update(
+                    group_id=insert_group_query.inserted.group_id))
 
-                if count == 0:
-                    insert_group_query = insert(self.vk_groups).values(
-                        group_id=group_id, status_id=1)
-                    connection.execute(insert_group_query)
+                select_ids_query = select(self.vk_user_ids.c.id, self.vk_groups.c.id).where(
+                    self.vk_user_ids.c.vk_user_id == vk_user_id, self.vk_groups.c.group_id == group_id)
+                # IGNORE instead of ON DUPLICATE KEY UPDATE: in INSERT ... SELECT
+                # the UPDATE clause would also see vk_groups.group_id (error 1052)
+                connection.execute(insert(self.id_group_link).prefix_with("IGNORE").from_select(
+                    ["vk_user_id", "group_id"], select_ids_query))
 
-                select_group_id_query = select(self.vk_groups.c.id).where(
+                select_status_query = select(self.vk_groups.c.status_id).where(
                     self.vk_groups.c.group_id == group_id)
-                group_id_link = connection.execute(
-                    select_group_id_query).fetchall()[0][0]
-
-                select_vk_user_id_query = select(self.vk_user_ids.c.id).where(
-                    self.vk_user_ids.c.vk_user_id == vk_user_id)
-                vk_user_id_link = connection.execute(
-                    select_vk_user_id_query).fetchall()[0][0]
-
-                insert_link_query = insert(self.id_group_link).values(
-                    group_id=group_id_link, vk_user_id=vk_user_id_link)
-                connection.execute(insert_link_query)
+                status = connection.execute(select_status_query).scalar()
+            self._mark_written(("user", vk_user_id), ("group", group_id))
+            return status
         except Exception as exc:
             raise DBException(f"Error in add_group: {exc}") from exc
 
@@ -113,25 +231,48 @@ class Database():
                 update_query = update(self.vk_groups).where(
                     self.vk_groups.c.group_id == group_id).values(status_id=status)
                 connection.execute(update_query)
+            self._mark_written(("group", group_id))
         except Exception as exc:
             raise DBException(f"Error in update_group_status: {exc}") from exc
 
-    def get_group_status(self, group_id):
+    def get_group_status(self, group_id, primary=False):
+        # A group missing on a replica may have just been added through
+        # another worker, whose sticky keys this process does not see, so
+        # the primary is asked before answering "not in database"
         try:
-            with self.engine.connect() as connection:
-                select_query = select(self.vk_groups).where(
-                    self.vk_groups.c.group_id == group_id)
-                result = connection.execute(select_query).fetchall()
-                if len(result) == 0:
-                    return 2  # GROUP NOT IN DATABASE
-                status = result[0][2]
-                return status
+            engine = self._read_engine(("group", group_id), primary=primary)
+            statuses = self._select_group_statuses(engine, [group_id])
+            if not statuses and engine is not self.engine:
+                statuses = self._select_group_statuses(self.engine, [group_id])
+            return statuses.get(group_id, 2)  # 2 - GROUP NOT IN DATABASE
         except Exception as exc:
             raise DBException(f"Error in get_group_status: {exc}") from exc
 
-    def get_all_groups(self):
+    def get_group_statuses(self, group_ids, primary=False):
+        # {group_id: status_id} for all group_ids in one query, 2 for unknown
+        # groups; groups missing on a replica are looked up on the primary
+        if not group_ids:
+            return {}
         try:
-            with self.engine.connect() as connection:
+            keys = [("group", group_id) for group_id in group_ids]
+            engine = self._read_engine(*keys, primary=primary)
+            result = self._select_group_statuses(engine, group_ids)
+            missing = [group_id for group_id in group_ids if group_id not in result]
+            if missing and engine is not self.engine:
+                result.update(self._select_group_statuses(self.engine, missing))
+            return {group_id: result.get(group_id, 2) for group_id in group_ids}
+        except Exception as exc:
+            raise DBException(f"Error in get_group_statuses: {exc}") from exc
+
+    def _select_group_statuses(self, engine, group_ids):
+        with engine.connect() as connection:
+            select_query = select(self.vk_groups.c.group_id, self.vk_groups.c.status_id).where(
+                self.vk_groups.c.group_id.in_(list(group_ids)))
+            return dict(connection.execute(select_query).fetchall())
+
+    def get_all_groups(self, primary=False):
+        try:
+            with self._read_engine(primary=primary).connect() as connection:
                 select_query = select(self.vk_groups)
                 result = connection.execute(select_query).fetchall()
                 groups = [GroupAndStatusModel(
@@ -140,26 +281,407 @@ class Database():
         except Exception as exc:
             raise DBException(f"Error in get_all_groups: {exc}") from exc
 
-    def get_owned_groups(self, vk_user_id):
+    def get_owned_groups(self, vk_user_id, offset=None, count=None, after=None, primary=False):
+        # Returns (groups, total). Groups are ordered by group_id; "after" is a
+        # keyset cursor (the last group_id of the previous page), "offset" is
+        # the classic LIMIT/OFFSET alternative
         try:
-            with self.engine.connect() as connection:
-                select_vk_user_id_query = select(self.vk_user_ids.c.id).where(
+            with self._read_engine(("user", vk_user_id), primary=primary).connect() as connection:
+                owned = self.vk_user_ids.join(
+                    self.id_group_link, self.id_group_link.c.vk_user_id == self.vk_user_ids.c.id)
+                total_query = select(func.count()).select_from(owned).where(
                     self.vk_user_ids.c.vk_user_id == vk_user_id)
-                vk_user_id_link = connection.execute(
-                    select_vk_user_id_query).fetchall()[0][0]
-
-                select_group_ids_query = select(self.id_group_link.c.group_id).where(
-                    self.id_group_link.c.vk_user_id == vk_user_id_link)
-                select_group_ids = connection.execute(
-                    select_group_ids_query).fetchall()
-                select_group_ids = [row[0] for row in select_group_ids]
 
-                select_query = select(self.vk_groups).where(
-                    self.vk_groups.c.id.in_(select_group_ids))
+                select_query = select(self.vk_groups.c.group_id, self.vk_groups.c.status_id,
+                                      total_query.scalar_subquery()).select_from(
+                    owned.join(self.vk_groups, self.vk_groups.c.id == self.id_group_link.c.group_id)).where(
+                    self.vk_user_ids.c.vk_user_id == vk_user_id).order_by(self.vk_groups.c.group_id)
+                if after is not None:
+                    select_query = select_query.where(
+                        self.vk_groups.c.group_id > after)
+                if count is not None:
+                    select_query = select_query.limit(count)
+                if offset is not None:
+                    select_query = select_query.offset(offset)
                 result = connection.execute(select_query).fetchall()
 
+                if len(result) > 0:
+                    total = result[0][2]
+                else:
+                    total = connection.execute(total_query).scalar()
+
                 groups = [GroupAndStatusModel(
-                    group_id=row[1], group_status=row[2]) for row in result]
-                return groups
+                    group_id=row[0], group_status=row[1]) for row in result]
+                return groups, total
         except Exception as exc:
             raise DBException(f"Error in get_owned_groups: {exc}") from exc
+
+    def get_not_ready_groups(self, primary=False):
+        try:
+            with self._read_engine(primary=primary).connect() as connection:
+                select_query = select(self.vk_groups.c.group_id).where(
+                    self.vk_groups.c.status_id != 0)
+                result = connection.execute(select_query).fetchall()
+                return [row[0] for row in result]
+        except Exception as exc:
+            raise DBException(f"Error in get_not_ready_groups: {exc}") from exc
+
+    def count_groups_by_status(self, primary=False):
+        try:
+            with self._read_engine(primary=primary).connect() as connection:
+                select_query = select(self.vk_groups.c.status_id, func.count()).group_by(
+                    self.vk_groups.c.status_id)
+                result = connection.execute(select_query).fetchall()
+                return {row[0]: row[1] for row in result}
+        except Exception as exc:
+            raise DBException(f"Error in count_groups_by_status: {exc}") from exc
+
+    def update_group_statuses(self, statuses):
+        # statuses: {group_id: status_id}, one UPDATE ... CASE for all groups
+        if not statuses:
+            return
+        try:
+            with self.engine.connect() as connection:
+                update_query = update(self.vk_groups).where(
+                    self.vk_groups.c.group_id.in_(list(statuses))).values(
+                        status_id=case(statuses, value=self.vk_groups.c.group_id))
+                connection.execute(update_query)
+            self._mark_written(*[("group", group_id) for group_id in statuses])
+        except Exception as exc:
+            raise DBException(f"Error in update_group_statuses: {exc}") from exc
+
+    def add_job(self, job_id, vk_user_id, service_name, group_id, hint):
+        try:
+            now = datetime.datetime.utcnow()
+            with self.engine.connect() as connection:
+                insert_query = insert(self.generation_jobs).values(
+                    job_id=job_id, vk_user_id=vk_user_id, service_name=service_name, group_id=group_id,
+                    hint=hint, job_status=0, result_status=0, result="", created=now, updated=now)
+                connection.execute(insert_query)
+            self._mark_written(("job", job_id))
+        except Exception as exc:
+            raise DBException(f"Error in add_job: {exc}") from exc
+
+    def claim_job(self, job_id):
+        # Returns True only for the one caller that moved the job from queued
+        # to running, so a job enqueued by several workers runs once
+        try:
+            with self.engine.connect() as connection:
+                update_query = update(self.generation_jobs).where(
+                    self.generation_jobs.c.job_id == job_id, self.generation_jobs.c.job_status == 0).values(
+                        job_status=1, updated=datetime.datetime.utcnow())
+                claimed = connection.execute(update_query).rowcount == 1
+            self._mark_written(("job", job_id))
+            return claimed
+        except Exception as exc:
+            raise DBException(f"Error in claim_job: {exc}") from exc
+
+    def finish_job(self, job_id, result_status, result):
+        try:
+            with self.engine.connect() as connection:
+                update_query = update(self.generation_jobs).where(
+                    self.generation_jobs.c.job_id == job_id).values(
+                        job_status=2 if result_status == 0 else 3, result_status=result_status,
+                        result=result, updated=datetime.datetime.utcnow())
+                connection.execute(update_query)
+            self._mark_written(("job", job_id))
+        except Exception as exc:
+            raise DBException(f"Error in finish_job: {exc}") from exc
+
+    def get_job(self, job_id, vk_user_id, primary=False):
+        try:
+            with self._read_engine(("job", job_id), primary=primary).connect() as connection:
+                select_query = select(self.generation_jobs.c.job_status, self.generation_jobs.c.result_status,
+                                      self.generation_jobs.c.result).where(
+                    self.generation_jobs.c.job_id == job_id, self.generation_jobs.c.vk_user_id == vk_user_id)
+                result = connection.execute(select_query).fetchall()
+                if len(result) == 0:
+                    return JobResultModel(status=0, job_status=4, data="")  # JOB NOT FOUND
+                job_status, result_status, data = result[0]
+                return JobResultModel(status=result_status, job_status=job_status, data=data)
+        except Exception as exc:
+            raise DBException(f"Error in get_job: {exc}") from exc
+
+    def touch_jobs(self, job_ids):
+        # Heartbeat of queued jobs sitting in a live worker's queue, so that
+        # get_unfinished_jobs of other workers does not take them
+        if not job_ids:
+            return
+        try:
+            with self.engine.connect() as connection:
+                update_query = update(self.generation_jobs).where(
+                    self.generation_jobs.c.job_id.in_(job_ids), self.generation_jobs.c.job_status == 0).values(
+                        updated=datetime.datetime.utcnow())
+                connection.execute(update_query)
+        except Exception as exc:
+            raise DBException(f"Error in touch_jobs: {exc}") from exc
+
+    def get_unfinished_jobs(self, stale_after):
+        # Jobs running or queued without a heartbeat for more than stale_after
+        # seconds belong to a dead worker. Running ones are put back to the
+        # queue; queued ones get a fresh updated, so the next sweep of another
+        # worker skips them. Returns the taken jobs as
+        # (job_id, service_name, group_id, hint), oldest first
+        try:
+            now = datetime.datetime.utcnow()
+            stale = now - datetime.timedelta(seconds=stale_after)
+            with self.engine.connect() as connection:
+                update_query = update(self.generation_jobs).where(
+                    self.generation_jobs.c.job_status == 1, self.generation_jobs.c.updated < stale).values(
+                        job_status=0)
+                connection.execute(update_query)
+
+                select_query = select(self.generation_jobs.c.job_id, self.generation_jobs.c.service_name,
+                                      self.generation_jobs.c.group_id, self.generation_jobs.c.hint).where(
+                    self.generation_jobs.c.job_status == 0, self.generation_jobs.c.updated < stale).order_by(
+                        self.generation_jobs.c.id)
+                jobs = [tuple(row) for row in connection.execute(select_query).fetchall()]
+                if jobs:
+                    update_query = update(self.generation_jobs).where(
+                        self.generation_jobs.c.job_id.in_([job[0] for job in jobs]),
+                        self.generation_jobs.c.job_status == 0).values(updated=now)
+                    connection.execute(update_query)
+                return jobs
+        except Exception as exc:
+            raise DBException(f"Error in get_unfinished_jobs: {exc}") from exc
+
+    def store_group_texts(self, group_id, texts):
+        # Texts already stored for the group (same sha256) are skipped
+        if not texts:
+            return
+        try:
+            rows = [{"group_id": group_id, "text_hash": hashlib.sha256(text.encode()).hexdigest(), "text": text}
+                    for text in texts]
+            with self.engine.connect() as connection:
+                insert_query = insert(self.group_texts).prefix_with("IGNORE")
+                connection.execute(insert_query, rows)
+        except Exception as exc:
+            raise DBException(f"Error in store_group_texts: {exc}") from exc
+
+    def get_group_texts_after(self, group_id, after_id, limit):
+        # Returns [(id, text)] with id > after_id in insertion order
+        try:
+            with self.engine.connect() as connection:
+                select_query = select(self.group_texts.c.id, self.group_texts.c.text).where(
+                    self.group_texts.c.group_id == group_id, self.group_texts.c.id > after_id).order_by(
+                    self.group_texts.c.id).limit(limit)
+                return [tuple(row) for row in connection.execute(select_query).fetchall()]
+        except Exception as exc:
+            raise DBException(f"Error in get_group_texts_after: {exc}") from exc
+
+    def get_corpus_group_ids(self):
+        try:
+            with self._read_engine().connect() as connection:
+                select_query = select(self.group_texts.c.group_id).distinct().order_by(
+                    self.group_texts.c.group_id)
+                return [row[0] for row in connection.execute(select_query).fetchall()]
+        except Exception as exc:
+            raise DBException(f"Error in get_corpus_group_ids: {exc}") from exc
+
+    def get_delivery_watermarks(self, group_id):
+        # Returns {(service_name, replica_url): last delivered group_texts.id}
+        try:
+            with self.engine.connect() as connection:
+                select_query = select(self.corpus_deliveries.c.service_name, self.corpus_deliveries.c.replica_url,
+                                      self.corpus_deliveries.c.last_text_id).where(
+                    self.corpus_deliveries.c.group_id == group_id)
+                return {(row[0], row[1]): row[2] for row in connection.execute(select_query).fetchall()}
+        except Exception as exc:
+            raise DBException(f"Error in get_delivery_watermarks: {exc}") from exc
+
+    def get_lagging_groups(self, service_name, replica_url):
+        # Returns {group_id: last delivered group_texts.id} of the groups whose
+        # stored corpus has texts the replica has not received yet
+        try:
+            latest = select(self.group_texts.c.group_id, func.max(self.group_texts.c.id).label("last_id")).group_by(
+                self.group_texts.c.group_id).subquery()
+            own = self.corpus_deliveries.alias("own")
+            legacy = self.corpus_deliveries.alias("legacy")
+            delivered = func.coalesce(own.c.last_text_id, legacy.c.last_text_id, 0)
+            select_query = select(latest.c.group_id, delivered).select_from(
+                latest.outerjoin(own, and_(own.c.group_id == latest.c.group_id, own.c.service_name == service_name,
+                                           own.c.replica_url == replica_url)).outerjoin(
+                    legacy, and_(legacy.c.group_id == latest.c.group_id, legacy.c.service_name == service_name,
+                                 legacy.c.replica_url == ""))).where(latest.c.last_id > delivered)
+            with self.engine.connect() as connection:
+                return dict(connection.execute(select_query).fetchall())
+        except Exception as exc:
+            raise DBException(f"Error in get_lagging_groups: {exc}") from exc
+
+    def set_delivery_watermark(self, service_name, replica_url, group_id, last_text_id):
+        try:
+            with self.engine.connect() as connection:
+                insert_query = insert(self.corpus_deliveries).values(
+                    service_name=service_name, replica_url=replica_url, group_id=group_id,
+                    last_text_id=last_text_id, updated=datetime.datetime.utcnow())
+                connection.execute(insert_query.on_duplicate_key_update(
+                    last_text_id=insert_query.inserted.last_text_id, updated=insert_query.inserted.updated))
+        except Exception as exc:
+            raise DBException(f"Error in set_delivery_watermark: {exc}") from exc
+
+    def reset_delivery_watermarks(self, service_name, replica_url=None):
+        # Forgets deliveries to the service, or only to one of its replicas
+        try:
+            with self.engine.connect() as connection:
+                delete_query = delete(self.corpus_deliveries).where(
+                    self.corpus_deliveries.c.service_name == service_name)
+                if replica_url is not None:
+                    delete_query = delete_query.where(
+                        self.corpus_deliveries.c.replica_url == replica_url)
+                connection.execute(delete_query)
+        except Exception as exc:
+            raise DBException(f"Error in reset_delivery_watermarks: {exc}") from exc
+
+    def try_acquire_lock(self, lock_name):
+        # Named locks belong to a DB session, so the connection that got the
+        # lock is kept out of the pool while it is held. If the process dies,
+        # MariaDB releases the lock and another worker takes over
+        connection = self.lock_connections.get(lock_name)
+        if connection is not None:
+            try:
+                if connection.execute(text("SELECT IS_USED_LOCK(:name) = CONNECTION_ID()"),
+                                      {"name": lock_name}).scalar() == 1:
+                    return True
+            except Exception:
+                pass
+            self._drop_lock_connection(lock_name)
+        try:
+            connection = self.engine.connect()
+            if connection.execute(text("SELECT GET_LOCK(:name, 0)"), {"name": lock_name}).scalar() == 1:
+                self.lock_connections[lock_name] = connection
+                return True
+            connection.close()
+            return False
+        except Exception as exc:
+            raise DBException(f"Error in try_acquire_lock: {exc}") from exc
+
+    def release_lock(self, lock_name):
+        connection = self.lock_connections.get(lock_name)
+        if connection is None:
+            return
+        try:
+            connection.execute(text("SELECT RELEASE_LOCK(:name)"), {"name": lock_name})
+        except Exception:
+            pass
+        self._drop_lock_connection(lock_name)
+
+    def _drop_lock_connection(self, lock_name):
+        connection = self.lock_connections.pop(lock_name)
+        # never return a session that may still hold the lock to the pool
+        connection.invalidate()
+        connection.close()
+
+
+class AsyncDatabase():
+    """
+    Асинхронная обёртка над Database: каждый метод выполняется в ограниченном
+    пуле потоков, поэтому запросы к БД не блокируют event loop. Размер пула
+    потоков стоит держать не больше pool_size + max_overflow движка
+    """
+
+    def __init__(self, db, workers=30):
+        self.db = db
+        self.executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="db")
+
+    async def _run(self, method, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        try:
+            with tracing.span("db"):
+                return await loop.run_in_executor(self.executor, functools.partial(method, *args, **kwargs))
+        except Exception:
+            metrics.DB_QUERY_ERRORS.labels(method.__name__).inc()
+            raise
+        finally:
+            # includes the wait for a free executor thread
+            metrics.DB_QUERY_LATENCY.labels(
+                method.__name__).observe(time.monotonic() - start)
+
+    def close(self):
+        self.executor.shutdown(wait=False)
+        self.db.dispose()
+
+    async def migrate(self):
+        return await self._run(self.db.migrate)
+
+    async def add_user_id(self, vk_user_id):
+        return await self._run(self.db.add_user_id, vk_user_id)
+
+    async def is_valid_user_id(self, vk_user_id, primary=False):
+        return await self._run(self.db.is_valid_user_id, vk_user_id, primary=primary)
+
+    async def get_recent_user_ids(self, limit, primary=False):
+        return await self._run(self.db.get_recent_user_ids, limit, primary=primary)
+
+    async def add_group(self, group_id, vk_user_id):
+        return await self._run(self.db.add_group, group_id, vk_user_id)
+
+    async def update_group_status(self, group_id, status):
+        return await self._run(self.db.update_group_status, group_id, status)
+
+    async def get_group_status(self, group_id, primary=False):
+        return await self._run(self.db.get_group_status, group_id, primary=primary)
+
+    async def get_group_statuses(self, group_ids, primary=False):
+        return await self._run(self.db.get_group_statuses, group_ids, primary=primary)
+
+    async def get_all_groups(self, primary=False):
+        return await self._run(self.db.get_all_groups, primary=primary)
+
+    async def get_owned_groups(self, vk_user_id, offset=None, count=None, after=None, primary=False):
+        return await self._run(self.db.get_owned_groups, vk_user_id, offset=offset, count=count, after=after, primary=primary)
+
+    async def get_not_ready_groups(self, primary=False):
+        return await self._run(self.db.get_not_ready_groups, primary=primary)
+
+    async def count_groups_by_status(self, primary=False):
+        return await self._run(self.db.count_groups_by_status, primary=primary)
+
+    async def update_group_statuses(self, statuses):
+        return await self._run(self.db.update_group_statuses, statuses)
+
+    async def add_job(self, job_id, vk_user_id, service_name, group_id, hint):
+        return await self._run(self.db.add_job, job_id, vk_user_id, service_name, group_id, hint)
+
+    async def claim_job(self, job_id):
+        return await self._run(self.db.claim_job, job_id)
+
+    async def finish_job(self, job_id, result_status, result):
+        return await self._run(self.db.finish_job, job_id, result_status, result)
+
+    async def get_job(self, job_id, vk_user_id, primary=False):
+        return await self._run(self.db.get_job, job_id, vk_user_id, primary=primary)
+
+    async def touch_jobs(self, job_ids):
+        return await self._run(self.db.touch_jobs, job_ids)
+
+    async def get_unfinished_jobs(self, stale_after):
+        return await self._run(self.db.get_unfinished_jobs, stale_after)
+
+    async def store_group_texts(self, group_id, texts):
+        return await self._run(self.db.store_group_texts, group_id, texts)
+
+    async def get_group_texts_after(self, group_id, after_id, limit):
+        return await self._run(self.db.get_group_texts_after, group_id, after_id, limit)
+
+    async def get_corpus_group_ids(self):
+        return await self._run(self.db.get_corpus_group_ids)
+
+    async def get_delivery_watermarks(self, group_id):
+        return await self._run(self.db.get_delivery_watermarks, group_id)
+
+    async def get_lagging_groups(self, service_name, replica_url):
+        return await self._run(self.db.get_lagging_groups, service_name, replica_url)
+
+    async def set_delivery_watermark(self, service_name, replica_url, group_id, last_text_id):
+        return await self._run(self.db.set_delivery_watermark, service_name, replica_url, group_id, last_text_id)
+
+    async def reset_delivery_watermarks(self, service_name, replica_url=None):
+        return await self._run(self.db.reset_delivery_watermarks, service_name, replica_url)
+
+    async def try_acquire_lock(self, lock_name):
+        return await self._run(self.db.try_acquire_lock, lock_name)
+
+    async def release_lock(self, lock_name):
+        return await self._run(self.db.release_lock, lock_name)
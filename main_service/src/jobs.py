@@ -0,0 +1,128 @@
+import asyncio
+import logging
+import uuid
+from microservices import MicroserviceException
+from database import DBException
+
+
+class JobQueueFull(Exception):
+    pass
+
+
+class JobQueue:
+    """
+    Очередь задач генерации. На каждый сервис своя ограниченная очередь
+    (queue_size) и max_concurrency обработчиков. Задачи хранятся в таблице
+    generation_jobs, поэтому после перезапуска воркера незавершённые задачи
+    снова ставятся в очередь. Воркер раз в HEARTBEAT_EVERY секунд обновляет
+    updated своих ждущих задач и забирает задачи, которые никто не обновлял
+    дольше STALE_AFTER секунд, так что задачи упавшего воркера подхватит
+    любой живой, а задачи живых воркеров остаются у них. claim_job
+    гарантирует, что задача выполнится один раз, даже если её подхватили
+    несколько воркеров
+    """
+
+    # running or queued jobs not updated for this long are considered abandoned
+    STALE_AFTER = 300
+    HEARTBEAT_EVERY = STALE_AFTER // 3
+
+    def __init__(self, db, mmgr, services, notifier):
+        self.db = db
+        self.mmgr = mmgr
+        self.notifier = notifier
+        self.queues = {service.docker_name: asyncio.Queue(service.queue_size)
+                       for service in services}
+        self.concurrency = {service.docker_name: service.max_concurrency
+                            for service in services}
+        self.tasks = []
+        # job ids sitting in this worker's queues, not enqueued twice by _recover
+        self.pending = set()
+
+    def start(self):
+        for service_name, queue in self.queues.items():
+            for _ in range(self.concurrency[service_name]):
+                self.tasks.append(asyncio.create_task(
+                    self._worker(service_name, queue)))
+        self.tasks.append(asyncio.create_task(self._recover()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+    async def submit(self, vk_user_id, service_name, group_id, hint):
+        queue = self.queues.get(service_name)
+        if queue is None:
+            raise MicroserviceException(
+                f"Wrong microservice name - {service_name}")
+        if queue.full():
+            raise JobQueueFull(f"Queue of {service_name} is full")
+
+        job_id = uuid.uuid4().hex
+        await self.db.add_job(job_id, vk_user_id, service_name, group_id, hint)
+        try:
+            queue.put_nowait((job_id, group_id, hint))
+            self.pending.add(job_id)
+        except asyncio.QueueFull as exc:
+            await self.db.finish_job(job_id, 6, "")
+            raise JobQueueFull(f"Queue of {service_name} is full") from exc
+        return job_id
+
+    async def _worker(self, service_name, queue):
+        while True:
+            job_id, group_id, hint = await queue.get()
+            try:
+                await self._run(service_name, job_id, group_id, hint)
+            except DBException as exc:
+                logging.error(f"JOB {job_id} DB ERROR: {exc}")
+            except Exception as exc:
+                logging.error(f"JOB {job_id} ERROR: {exc}")
+            finally:
+                self.pending.discard(job_id)
+                queue.task_done()
+
+    async def _run(self, service_name, job_id, group_id, hint):
+        if not await self.db.claim_job(job_id):
+            return
+        try:
+            result = await self.mmgr.generate(service_name, group_id, hint)
+            status = 0
+        except MicroserviceException as exc:
+            logging.error(f"JOB {job_id} MICROSERVICE ERROR: {exc}")
+            result, status = "", 4
+        except Exception as exc:
+            logging.error(f"JOB {job_id} ERROR: {exc}")
+            result, status = "", 2
+        await self.db.finish_job(job_id, status, result)
+        self.notifier.notify(job_id)
+
+    async def _recover(self):
+        while True:
+            await self._heartbeat()
+            await self._recover_once()
+            await asyncio.sleep(self.HEARTBEAT_EVERY)
+
+    async def _heartbeat(self):
+        try:
+            await self.db.touch_jobs(list(self.pending))
+        except DBException as exc:
+            logging.error(f"DB ERROR while touching queued jobs: {exc}")
+
+    async def _recover_once(self):
+        try:
+            jobs = await self.db.get_unfinished_jobs(self.STALE_AFTER)
+        except DBException as exc:
+            logging.error(f"DB ERROR while recovering jobs: {exc}")
+            return
+        jobs = [job for job in jobs if job[0] not in self.pending]
+        if jobs:
+            logging.info(f"Recovering {len(jobs)} unfinished jobs")
+        for job_id, service_name, group_id, hint in jobs:
+            queue = self.queues.get(service_name)
+            if queue is None:
+                await self.db.finish_job(job_id, 4, "")
+                continue
+            # waits for free space, recovered jobs must not be rejected
+            self.pending.add(job_id)
+            await queue.put((job_id, group_id, hint))
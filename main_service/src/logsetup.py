@@ -0,0 +1,94 @@
+import atexit
+import json
+import logging
+import queue
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import tracing
+
+
+# attributes every LogRecord has, everything else came in through extra=
+_RECORD_ATTRS = set(vars(logging.LogRecord(
+    "", 0, "", 0, "", None, None))) | {"message", "asctime"}
+
+
+def truncate(value, max_length):
+    if isinstance(value, str) and len(value) > max_length:
+        return f"{value[:max_length]}...(+{len(value) - max_length})"
+    return value
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Одна строка JSON на запись: время, уровень, логгер, сообщение и поля,
+    переданные через extra=. Строковые поля длиннее max_field_length обрезаются
+    """
+
+    def __init__(self, max_field_length=256):
+        super().__init__()
+        self.max_field_length = max_field_length
+
+    def format(self, record):
+        payload = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS and key not in payload:
+                payload[key] = truncate(value, self.max_field_length)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            payload["exc"] = record.exc_text
+        return json.dumps(payload, ensure_ascii=False, default=str)
+
+
+class _EnqueueHandler(QueueHandler):
+    def prepare(self, record):
+        # QueueHandler.prepare formats the record with a plain formatter
+        # and drops exc_info; keep it as is for JsonFormatter instead, only
+        # freezing the message and the traceback text in the calling thread
+        record.msg = record.getMessage()
+        record.args = None
+        rid = tracing.request_id.get()
+        if rid is not None:
+            record.request_id = rid
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+def setup_logging(filename=None, level="INFO", max_bytes=50 << 20, backup_count=5, max_field_length=256):
+    """
+    Логи пишутся в отдельном потоке: обработчики кладут записи в очередь,
+    QueueListener пишет их в файл с ротацией по размеру (без filename - в
+    stderr). Возвращает listener, он останавливается (с дозаписью очереди)
+    при выходе из процесса
+    """
+    if filename is None:
+        handler = logging.StreamHandler()
+    else:
+        handler = RotatingFileHandler(
+            filename, maxBytes=max_bytes, backupCount=backup_count, encoding="UTF-8")
+    handler.setFormatter(JsonFormatter(max_field_length))
+
+    log_queue = queue.SimpleQueue()
+    listener = QueueListener(log_queue, handler,
+                             respect_handler_level=True)
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(_EnqueueHandler(log_queue))
+    root.setLevel(level)
+    listener.start()
+    atexit.register(stop_listener, listener)
+    return listener
+
+
+def stop_listener(listener):
+    # QueueListener.stop fails when called twice
+    if listener._thread is not None:
+        listener.stop()
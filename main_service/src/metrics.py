@@ -0,0 +1,66 @@
+import os
+import time
+from functools import wraps
+from prometheus_client import (CONTENT_TYPE_LATEST, CollectorRegistry, Counter, Gauge, Histogram,
+                               generate_latest, multiprocess)
+
+
+# with several uvicorn workers set PROMETHEUS_MULTIPROC_DIR to an empty
+# directory shared by the workers, /metrics then aggregates all of them
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1, 2.5, 5, 10, 30, 60, 90, 120)
+
+ROUTE_LATENCY = Histogram("strawberry_route_latency_seconds", "Request handling time by route",
+                          ["route"], buckets=LATENCY_BUCKETS)
+ROUTE_RESULTS = Counter("strawberry_route_results_total", "Responses by route and OperationResult status code",
+                        ["route", "status"])
+GENERATE_FIRST_CHUNK = Histogram("strawberry_generate_first_chunk_seconds",
+                                 "Time to the first streamed chunk of /generate_stream", buckets=LATENCY_BUCKETS)
+MICROSERVICE_LATENCY = Histogram("strawberry_microservice_latency_seconds", "Microservice call time",
+                                 ["service", "path"], buckets=LATENCY_BUCKETS)
+MICROSERVICE_ERRORS = Counter("strawberry_microservice_errors_total", "Failed microservice calls",
+                              ["service", "path"])
+DB_QUERY_LATENCY = Histogram("strawberry_db_query_seconds", "Database method time",
+                             ["method"], buckets=LATENCY_BUCKETS)
+DB_QUERY_ERRORS = Counter("strawberry_db_query_errors_total", "Failed database methods",
+                          ["method"])
+POLLER_CYCLE = Histogram("strawberry_poller_cycle_seconds", "check_statuses cycle time",
+                         buckets=LATENCY_BUCKETS)
+POLLER_GROUPS = Gauge("strawberry_poller_groups", "Groups by readiness as of the last poller cycle",
+                      ["state"], multiprocess_mode="livemax")
+
+
+def observe_route(route):
+    """
+    Декоратор ручки: время обработки и счётчик по полю status ответа.
+    Потоковые ответы без status считают статус сами через observe_result
+    """
+    def decorator(handler):
+        @wraps(handler)
+        async def wrapper(*args, **kwargs):
+            start = time.monotonic()
+            try:
+                result = await handler(*args, **kwargs)
+            finally:
+                ROUTE_LATENCY.labels(route).observe(time.monotonic() - start)
+            status = getattr(result, "status", None)
+            if isinstance(status, int):
+                observe_result(route, status)
+            return result
+        return wrapper
+    return decorator
+
+
+def observe_result(route, status):
+    ROUTE_RESULTS.labels(route, str(status)).inc()
+
+
+def render():
+    """Тело и Content-Type ответа /metrics"""
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
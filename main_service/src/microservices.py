@@ -1,68 +1,425 @@
-import requests
+import asyncio
+import json
+import logging
+import time
+from collections import Counter
+import httpx
+from cache import TTLCache, SingleFlight
+from balancer import Replica, ReplicaPool
+import metrics
+import tracing
 
 
 class MicroserviceException(Exception):
     pass
 
 
-class MicroserviceManager:
-    def __init__(self, microservices):
+class ChunksNotSupported(MicroserviceException):
+    pass
+
+
+class AsyncMicroserviceManager:
+    """
+    Клиент нейросетевых микросервисов. У каждого сервиса может быть
+    несколько реплик (ReplicaPool): генерация уходит в одну реплику, а
+    корпуса групп и проверки готовности - во все доступные. На каждую
+    реплику свой httpx.AsyncClient с пулом keep-alive соединений, обходы по
+    сервисам и репликам выполняются параллельно
+    """
+
+    ADD_GROUP_TIMEOUT = 15
+    GENERATE_TIMEOUT = 90
+    CHECK_STATUS_TIMEOUT = 2
+    CHECK_STATUSES_TIMEOUT = 10
+    CHECK_STATUSES_BATCH_SIZE = 500
+    HEALTH_CHECK_TIMEOUT = 2
+    CONNECT_TIMEOUT = 5
+
+    def __init__(self, microservices, pool_size=100, keepalive_size=20,
+                 generate_cache_size=1000, generate_cache_ttl=0,
+                 failure_threshold=5, eject_seconds=30):
         self.services = microservices
+        self.services_by_name = {
+            service.docker_name: service for service in microservices}
+        self.pools = {service.docker_name: ReplicaPool(
+            service.docker_name, [Replica(replica["url"], replica["port"])
+                                  for replica in service.replicas],
+            failure_threshold=failure_threshold, eject_seconds=eject_seconds)
+            for service in microservices}
+        self.limits = httpx.Limits(
+            max_connections=pool_size, max_keepalive_connections=keepalive_size)
+        self.clients = {}
+        self.health_task = None
+        # services that answered 404/405 on /check_statuses, /generate_stream,
+        # /add_group_chunk
+        self.no_batch_services = set()
+        self.no_stream_services = set()
+        self.no_chunk_services = set()
+        # identical concurrent generations share one upstream call, finished
+        # results are cached for services with cache_results enabled
+        self.generate_flight = SingleFlight()
+        self.generate_cache = TTLCache(
+            generate_cache_size, generate_cache_ttl) if generate_cache_ttl > 0 else None
+        self.generate_counters = Counter()
+
+    def _client(self, replica):
+        client = self.clients.get(replica.base_url)
+        if client is None:
+            client = httpx.AsyncClient(
+                base_url=replica.base_url, limits=self.limits)
+            self.clients[replica.base_url] = client
+        return client
+
+    def _timeout(self, seconds):
+        return httpx.Timeout(seconds, connect=min(seconds, self.CONNECT_TIMEOUT))
+
+    def _service(self, service_name):
+        service = self.services_by_name.get(service_name)
+        if service is None:
+            raise MicroserviceException(
+                f"Wrong microservice name - {service_name}")
+        return service
+
+    def _pick_replica(self, service):
+        replica = self.pools[service.docker_name].pick()
+        if replica is None:
+            raise MicroserviceException(
+                f"No available replicas of microservice {service.docker_name}")
+        return replica
+
+    def _data_replicas(self, service):
+        replicas = self.pools[service.docker_name].available()
+        if not replicas:
+            raise MicroserviceException(
+                f"No available replicas of microservice {service.docker_name}")
+        return replicas
 
-    def add_group(self, group_id, texts):
+    async def _request(self, service, replica, method, path, timeout, **kwargs):
+        """Один HTTP-запрос к реплике с учётом незавершённых запросов, задержки и ошибок"""
+        pool = self.pools[service.docker_name]
+        pool.started(replica)
+        start = time.monotonic()
+        ok = False
         try:
-            for service in self.services:
-                response = requests.post(f"{service.url}:{service.port}/add_group",
-                                         json={"group_id": group_id, "texts": texts}, timeout=15)
-                result = response.json()["result"]
-                if result == "ERROR":
-                    raise MicroserviceException(
-                        f"Internal microservice error (add_group): {service.docker_name}")
+            with tracing.span("upstream"):
+                response = await self._client(replica).request(
+                    method, path, timeout=self._timeout(timeout), headers=tracing.outgoing_headers(), **kwargs)
+            ok = response.status_code < 500
+            return response
+        finally:
+            latency = time.monotonic() - start
+            pool.finished(replica, latency, ok)
+            metrics.MICROSERVICE_LATENCY.labels(
+                service.docker_name, path).observe(latency)
+            if not ok:
+                metrics.MICROSERVICE_ERRORS.labels(
+                    service.docker_name, path).inc()
+
+    def _internal_error(self, service, operation):
+        """Исключение для ответа {"result": "ERROR"}, такие ответы тоже считаются ошибками в метриках"""
+        metrics.MICROSERVICE_ERRORS.labels(
+            service.docker_name, f"/{operation}").inc()
+        return MicroserviceException(
+            f"Internal microservice error ({operation}): {service.docker_name}")
+
+    def start_health_checks(self, interval):
+        if self.health_task is None:
+            self.health_task = asyncio.create_task(
+                self._health_loop(interval))
+
+    async def _check_health(self, pool, replica):
+        try:
+            response = await self._client(replica).get(
+                "/health", timeout=self._timeout(self.HEALTH_CHECK_TIMEOUT))
+        except Exception:
+            pool.report_health(replica, False)
+            return
+        if response.status_code in (404, 405):
+            # no /health in this service: it answers, but that proves nothing,
+            # only real requests decide about ejection
+            return
+        pool.report_health(replica, response.status_code < 400)
+
+    async def _health_loop(self, interval):
+        while True:
+            await asyncio.gather(*[self._check_health(pool, replica)
+                                   for pool in self.pools.values() for replica in pool.replicas])
+            await asyncio.sleep(interval)
+
+    async def close(self):
+        if self.health_task is not None:
+            self.health_task.cancel()
+            await asyncio.gather(self.health_task, return_exceptions=True)
+            self.health_task = None
+        clients = list(self.clients.values())
+        self.clients = {}
+        await asyncio.gather(*[client.aclose() for client in clients])
+
+    def generate_stats(self):
+        return {"cache_hits": self.generate_counters["hits"],
+                "cache_misses": self.generate_counters["misses"],
+                "coalesced": self.generate_flight.coalesced,
+                "in_flight": len(self.generate_flight.calls),
+                "cached": 0 if self.generate_cache is None else len(self.generate_cache)}
+
+    def replica_stats(self):
+        now = time.monotonic()
+        return {name: [{"url": replica.base_url, "outstanding": replica.outstanding,
+                        "ewma_latency": round(replica.ewma_latency, 4), "failures": replica.failures,
+                        "available": replica.available(now), "catching_up": replica.catching_up}
+                       for replica in pool.replicas]
+                for name, pool in self.pools.items()}
+
+    async def _add_group_single(self, service, replica, group_id, texts):
+        try:
+            response = await self._request(service, replica, "POST", "/add_group",
+                                           self.ADD_GROUP_TIMEOUT, json={"group_id": group_id, "texts": texts})
+            result = response.json()["result"]
         except Exception as exc:
             raise MicroserviceException(
                 f"Error in microservice {service.docker_name} add_group {exc}") from exc
+        if result == "ERROR":
+            raise self._internal_error(service, "add_group")
 
-    def generate(self, service_name, group_id, hint):
+    async def _add_group_chunk(self, service, replica, group_id, texts, seq, last):
         try:
-            service_ind = -1
-            for i in range(len(self.services)):
-                if self.services[i].docker_name == service_name:
-                    service_ind = i
-                    break
+            response = await self._request(service, replica, "POST", "/add_group_chunk", self.ADD_GROUP_TIMEOUT,
+                                           json={"group_id": group_id, "texts": texts, "seq": seq, "last": last})
+            unsupported = response.status_code in (404, 405)
+            result = None if unsupported else response.json()["result"]
+        except Exception as exc:
+            raise MicroserviceException(
+                f"Error in microservice {service.docker_name} add_group_chunk {exc}") from exc
+        if unsupported:
+            self.no_chunk_services.add(service.docker_name)
+            raise ChunksNotSupported(
+                f"Microservice {service.docker_name} has no /add_group_chunk")
+        if result == "ERROR":
+            raise self._internal_error(service, "add_group_chunk")
 
-            if service_ind == -1:
-                raise MicroserviceException(
-                    f"Wrong microservice name - {service_name}")
+    def replica_urls(self, service_name, available_only=False):
+        pool = self.pools[self._service(service_name).docker_name]
+        replicas = pool.available() if available_only else pool.replicas
+        return [replica.base_url for replica in replicas]
+
+    def set_catching_up(self, service_name, replica_url, catching_up):
+        """Пока реплика догоняет корпус, генерация уходит в другие реплики сервиса"""
+        for replica in self.pools[self._service(service_name).docker_name].replicas:
+            if replica.base_url == replica_url:
+                replica.catching_up = catching_up
+
+    def supports_chunks(self, service_name):
+        """False, если сервис уже ответил 404/405 на /add_group_chunk"""
+        return self._service(service_name).docker_name not in self.no_chunk_services
+
+    def _replicas_by_url(self, service, replica_urls):
+        if replica_urls is None:
+            return self._data_replicas(service)
+        replicas = [replica for replica in self.pools[service.docker_name].replicas
+                    if replica.base_url in replica_urls]
+        missing = set(replica_urls) - \
+            {replica.base_url for replica in replicas}
+        if missing:
+            raise MicroserviceException(
+                f"Microservice {service.docker_name} has no replicas {sorted(missing)}")
+        return replicas
+
+    async def send_group_chunks(self, service_name, group_id, chunks, replica_urls=None):
+        """
+        Отправляет тексты из асинхронного итератора chunks во все доступные
+        реплики сервиса (или только в реплики replica_urls). Каждая часть - это
+        POST /add_group_chunk {"group_id", "texts", "seq", "last"}: seq
+        считается с 0 в каждой отправке, части приходят по порядку, после
+        всех текстов приходит пустая часть с last=true, и только после неё
+        сервису стоит (до)обучаться на группе. Тексты - дополнение к тому, что
+        сервис уже получил раньше, а не весь корпус. Сервис без
+        /add_group_chunk (404/405) вызывает ChunksNotSupported, такому сервису
+        весь корпус отправляется через send_group_corpus
+        """
+        service = self._service(service_name)
+        replicas = self._replicas_by_url(service, replica_urls)
+        seq = 0
+        async for texts in chunks:
+            await asyncio.gather(*[self._add_group_chunk(service, replica, group_id, texts, seq, False)
+                                   for replica in replicas])
+            seq += 1
+        await asyncio.gather(*[self._add_group_chunk(service, replica, group_id, [], seq, True)
+                               for replica in replicas])
+
+    async def send_group_corpus(self, service_name, group_id, texts, replica_urls=None):
+        """
+        Отправляет весь корпус группы одним POST /add_group {"group_id",
+        "texts"} во все доступные реплики сервиса (или только в реплики
+        replica_urls). Для сервисов без /add_group_chunk: они заменяют
+        корпус группы присланными текстами
+        """
+        service = self._service(service_name)
+        replicas = self._replicas_by_url(service, replica_urls)
+        await asyncio.gather(*[self._add_group_single(service, replica, group_id, texts)
+                               for replica in replicas])
 
-            service = self.services[service_ind]
+    async def generate(self, service_name, group_id, hint):
+        service = self._service(service_name)
+        key = (service_name, group_id, hint)
+        use_cache = self.generate_cache is not None and service.cache_results
+        if use_cache:
+            result = self.generate_cache.get(key)
+            if result is not None:
+                self.generate_counters["hits"] += 1
+                return result
+        self.generate_counters["misses"] += 1
 
-            response = requests.post(
-                f"{service.url}:{service.port}/generate", json={"group_id": group_id, "hint": hint}, timeout=90)
+        result = await self.generate_flight.do(
+            key, lambda: self._generate_single(service, group_id, hint))
+        if use_cache:
+            self.generate_cache.set(key, result)
+        return result
+
+    async def _generate_single(self, service, group_id, hint):
+        replica = self._pick_replica(service)
+        try:
+            response = await self._request(service, replica, "POST", "/generate",
+                                           self.GENERATE_TIMEOUT, json={"group_id": group_id, "hint": hint})
             result = response.json()["result"]
-            if result == "ERROR":
-                raise MicroserviceException(
-                    f"Internal microservice error (generate): {service.docker_name}")
-            return result
         except Exception as exc:
             raise MicroserviceException(
                 f"Error in microservice {service.docker_name} generate: {exc}") from exc
+        if result == "ERROR":
+            raise self._internal_error(service, "generate")
+        return result
+
+    async def generate_stream(self, service_name, group_id, hint):
+        """
+        Асинхронный генератор кусков текста. Сервис отвечает на
+        POST /generate_stream строками NDJSON вида {"result": "кусок"}; если
+        сервис так не умеет (404/405), весь результат /generate отдаётся
+        одним куском
+        """
+        service = self._service(service_name)
+        if service.docker_name not in self.no_stream_services:
+            replica = self._pick_replica(service)
+            pool = self.pools[service.docker_name]
+            pool.started(replica)
+            start = time.monotonic()
+            ok = False
+            try:
+                async with self._client(replica).stream(
+                        "POST", "/generate_stream", json={"group_id": group_id, "hint": hint},
+                        headers=tracing.outgoing_headers(), timeout=self._timeout(self.GENERATE_TIMEOUT)) as response:
+                    ok = response.status_code < 500
+                    if response.status_code not in (404, 405):
+                        async for line in response.aiter_lines():
+                            if not line:
+                                continue
+                            result = json.loads(line)["result"]
+                            if result == "ERROR":
+                                raise self._internal_error(service, "generate_stream")
+                            yield result
+                        return
+            except MicroserviceException:
+                raise
+            except Exception as exc:
+                ok = False
+                raise MicroserviceException(
+                    f"Error in microservice {service.docker_name} generate_stream: {exc}") from exc
+            finally:
+                latency = time.monotonic() - start
+                pool.finished(replica, latency, ok)
+                metrics.MICROSERVICE_LATENCY.labels(
+                    service.docker_name, "/generate_stream").observe(latency)
+                if not ok:
+                    metrics.MICROSERVICE_ERRORS.labels(
+                        service.docker_name, "/generate_stream").inc()
+            logging.info(
+                f"Microservice {service.docker_name} has no /generate_stream, falling back to /generate")
+            self.no_stream_services.add(service.docker_name)
+
+        yield await self.generate(service_name, group_id, hint)
 
-    def check_status(self, group_id):
+    async def _check_status_single(self, service, replica, group_id):
         try:
-            ready_count = 0
-            total_count = len(self.services)
-            for service in self.services:
-                response = requests.get(
-                    f"{service.url}:{service.port}/check_status", params={"group_id": group_id}, timeout=2)
-                result = response.json()["result"]
-                if result == "ERROR":
-                    raise MicroserviceException(
-                        f"Internal microservice error (check_status): {service.docker_name}")
-                if result == "OK":
-                    ready_count += 1
-            if ready_count == total_count:
-                return True
-            return False
+            response = await self._request(service, replica, "GET", "/check_status",
+                                           self.CHECK_STATUS_TIMEOUT, params={"group_id": group_id})
+            result = response.json()["result"]
         except Exception as exc:
             raise MicroserviceException(
                 f"Error in microservice {service.docker_name} check_status: {exc}") from exc
+        if result == "ERROR":
+            raise self._internal_error(service, "check_status")
+        return result == "OK"
+
+    async def _check_status_batch(self, service, replica, group_ids):
+        try:
+            response = await self._request(service, replica, "POST", "/check_statuses",
+                                           self.CHECK_STATUSES_TIMEOUT, json={"group_ids": group_ids})
+            if response.status_code in (404, 405):
+                return None
+            result = response.json()["result"]
+        except Exception as exc:
+            raise MicroserviceException(
+                f"Error in microservice {service.docker_name} check_statuses: {exc}") from exc
+        if result == "ERROR":
+            raise self._internal_error(service, "check_statuses")
+        return {group_id: result.get(str(group_id)) == "OK" for group_id in group_ids}
+
+    async def _check_statuses_replica(self, service, replica, group_ids, semaphore):
+        async def batch(chunk):
+            async with semaphore:
+                return await self._check_status_batch(service, replica, chunk)
+
+        async def single(group_id):
+            async with semaphore:
+                return await self._check_status_single(service, replica, group_id)
+
+        if service.docker_name not in self.no_batch_services:
+            size = self.CHECK_STATUSES_BATCH_SIZE
+            chunks = [group_ids[i:i + size]
+                      for i in range(0, len(group_ids), size)]
+            results = await asyncio.gather(*[batch(chunk) for chunk in chunks],
+                                           return_exceptions=True)
+            if not any(result is None for result in results):
+                statuses = {}
+                for result in results:
+                    if isinstance(result, Exception):
+                        logging.error(str(result))
+                    else:
+                        statuses.update(result)
+                return statuses
+            logging.info(
+                f"Microservice {service.docker_name} has no /check_statuses, falling back to /check_status")
+            self.no_batch_services.add(service.docker_name)
+
+        results = await asyncio.gather(*[single(group_id) for group_id in group_ids],
+                                       return_exceptions=True)
+        return {group_id: result for group_id, result in zip(group_ids, results)
+                if not isinstance(result, Exception)}
+
+    async def _check_statuses_single(self, service, group_ids, max_in_flight):
+        # a group is ready in a service only when every available replica has it
+        try:
+            replicas = self._data_replicas(service)
+        except MicroserviceException as exc:
+            logging.error(str(exc))
+            return {}
+        per_replica = await asyncio.gather(*[self._check_statuses_replica(
+            service, replica, group_ids, asyncio.Semaphore(max_in_flight)) for replica in replicas])
+        return {group_id: all(statuses[group_id] for statuses in per_replica)
+                for group_id in group_ids
+                if all(group_id in statuses for statuses in per_replica)}
+
+    async def check_statuses(self, group_ids, max_in_flight=50):
+        """
+        Проверяет готовность сразу нескольких групп. Сервисы, которые умеют
+        POST /check_statuses, опрашиваются пачками, остальные - по одной
+        группе через GET /check_status. Возвращает словарь group_id: bool,
+        группы, которые не удалось проверить хотя бы в одном сервисе, в
+        словарь не попадают
+        """
+        group_ids = list(group_ids)
+        if not group_ids:
+            return {}
+        per_service = await asyncio.gather(*[self._check_statuses_single(
+            service, group_ids, max_in_flight) for service in self.services])
+        return {group_id: all(statuses[group_id] for statuses in per_service)
+                for group_id in group_ids
+                if all(group_id in statuses for statuses in per_service)}
@@ -0,0 +1,145 @@
+import datetime
+import logging
+from sqlalchemy import text
+
+
+# (version, description, statements). Versions are applied in order, each one
+# exactly once; applied versions are recorded in schema_version. Never edit an
+# already released migration - append a new one instead
+MIGRATIONS = [
+    (1, "initial tables", [
+        """CREATE TABLE IF NOT EXISTS vk_user_ids (
+            id INTEGER NOT NULL AUTO_INCREMENT,
+            vk_user_id INTEGER NOT NULL,
+            acquired DATETIME NOT NULL,
+            PRIMARY KEY (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS vk_groups (
+            id INTEGER NOT NULL AUTO_INCREMENT,
+            group_id INTEGER NOT NULL,
+            status_id INTEGER NOT NULL,
+            PRIMARY KEY (id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS id_group_link (
+            vk_user_id INTEGER NOT NULL,
+            group_id INTEGER NOT NULL,
+            FOREIGN KEY (vk_user_id) REFERENCES vk_user_ids (id),
+            FOREIGN KEY (group_id) REFERENCES vk_groups (id)
+        )""",
+    ]),
+    (2, "unique and secondary indexes", [
+        # duplicates could appear through the old select-then-insert code:
+        # links are moved to the oldest row of every duplicate group/user first
+        """UPDATE id_group_link l
+            JOIN vk_user_ids u ON l.vk_user_id = u.id
+            JOIN (SELECT vk_user_id, MIN(id) AS keep_id FROM vk_user_ids GROUP BY vk_user_id) k
+                ON k.vk_user_id = u.vk_user_id
+            SET l.vk_user_id = k.keep_id
+            WHERE u.id <> k.keep_id""",
+        """UPDATE id_group_link l
+            JOIN vk_groups g ON l.group_id = g.id
+            JOIN (SELECT group_id, MIN(id) AS keep_id FROM vk_groups GROUP BY group_id) k
+                ON k.group_id = g.group_id
+            SET l.group_id = k.keep_id
+            WHERE g.id <> k.keep_id""",
+        """UPDATE vk_groups g
+            JOIN (SELECT group_id, MIN(id) AS keep_id, MIN(status_id) AS status_id
+                  FROM vk_groups GROUP BY group_id) k
+                ON g.id = k.keep_id
+            SET g.status_id = k.status_id""",
+        """DELETE u FROM vk_user_ids u
+            JOIN (SELECT vk_user_id, MIN(id) AS keep_id FROM vk_user_ids GROUP BY vk_user_id) k
+                ON k.vk_user_id = u.vk_user_id
+            WHERE u.id <> k.keep_id""",
+        """DELETE g FROM vk_groups g
+            JOIN (SELECT group_id, MIN(id) AS keep_id FROM vk_groups GROUP BY group_id) k
+                ON k.group_id = g.group_id
+            WHERE g.id <> k.keep_id""",
+        "ALTER TABLE vk_user_ids ADD UNIQUE INDEX ux_vk_user_ids_vk_user_id (vk_user_id)",
+        """ALTER TABLE vk_groups
+            ADD UNIQUE INDEX ux_vk_groups_group_id (group_id),
+            ADD INDEX ix_vk_groups_status_id (status_id)""",
+        # MariaDB drops duplicate rows when adding a unique index with IGNORE
+        "ALTER IGNORE TABLE id_group_link ADD UNIQUE INDEX ux_id_group_link (vk_user_id, group_id)",
+    ]),
+    (3, "generation jobs", [
+        """CREATE TABLE IF NOT EXISTS generation_jobs (
+            id INTEGER NOT NULL AUTO_INCREMENT,
+            job_id CHAR(32) NOT NULL,
+            vk_user_id INTEGER NOT NULL,
+            service_name VARCHAR(255) NOT NULL,
+            group_id INTEGER NOT NULL,
+            hint TEXT NOT NULL,
+            job_status INTEGER NOT NULL,
+            result_status INTEGER NOT NULL,
+            result MEDIUMTEXT NOT NULL,
+            created DATETIME NOT NULL,
+            updated DATETIME NOT NULL,
+            PRIMARY KEY (id),
+            UNIQUE INDEX ux_generation_jobs_job_id (job_id),
+            INDEX ix_generation_jobs_job_status (job_status, updated)
+        )""",
+    ]),
+    (4, "group corpus store", [
+        """CREATE TABLE IF NOT EXISTS group_texts (
+            id BIGINT NOT NULL AUTO_INCREMENT,
+            group_id INTEGER NOT NULL,
+            text_hash CHAR(64) NOT NULL,
+            text MEDIUMTEXT NOT NULL,
+            PRIMARY KEY (id),
+            UNIQUE INDEX ux_group_texts_group_id_text_hash (group_id, text_hash),
+            INDEX ix_group_texts_group_id_id (group_id, id)
+        )""",
+        """CREATE TABLE IF NOT EXISTS corpus_deliveries (
+            service_name VARCHAR(255) NOT NULL,
+            group_id INTEGER NOT NULL,
+            last_text_id BIGINT NOT NULL,
+            updated DATETIME NOT NULL,
+            PRIMARY KEY (service_name, group_id)
+        )""",
+    ]),
+    # existing rows keep replica_url = '' and act as the watermark of every
+    # replica of the service that has no row of its own
+    (5, "per-replica corpus deliveries", [
+        """ALTER TABLE corpus_deliveries
+            ADD COLUMN replica_url VARCHAR(255) NOT NULL DEFAULT '' AFTER service_name,
+            DROP PRIMARY KEY,
+            ADD PRIMARY KEY (service_name, replica_url, group_id)""",
+    ]),
+]
+
+LOCK_NAME = "strawberry_migrations"
+LOCK_TIMEOUT = 60
+
+
+def run_migrations(engine):
+    """Применяет недостающие миграции, возвращает список применённых версий"""
+    applied_now = []
+    with engine.connect() as connection:
+        # several workers may start at once, only one of them migrates
+        if connection.execute(text("SELECT GET_LOCK(:name, :timeout)"),
+                              {"name": LOCK_NAME, "timeout": LOCK_TIMEOUT}).scalar() != 1:
+            raise TimeoutError("Could not acquire migrations lock")
+        try:
+            connection.execute(text("""CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER NOT NULL,
+                description VARCHAR(255) NOT NULL,
+                applied DATETIME NOT NULL,
+                PRIMARY KEY (version)
+            )"""))
+            applied = {row[0] for row in connection.execute(
+                text("SELECT version FROM schema_version"))}
+
+            for version, description, statements in MIGRATIONS:
+                if version in applied:
+                    continue
+                logging.info(f"Applying migration {version}: {description}")
+                for statement in statements:
+                    connection.execute(text(statement))
+                connection.execute(text("INSERT INTO schema_version (version, description, applied) VALUES (:version, :description, :applied)"),
+                                   {"version": version, "description": description, "applied": datetime.datetime.utcnow()})
+                applied_now.append(version)
+        finally:
+            connection.execute(text("SELECT RELEASE_LOCK(:name)"),
+                               {"name": LOCK_NAME})
+    return applied_now
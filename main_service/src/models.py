@@ -1,3 +1,4 @@
+from typing import Optional
 from pydantic import BaseModel
 
 
@@ -11,6 +12,9 @@ class OperationResult(BaseModel):
      * 3 - neural network is not ready
      * 4 - microservice error
      * 5 - db error
+     * 6 - generation queue is full
+     * 7 - request rejected by rate limit or overload
+     * 8 - too many items in a batch request
     """
     status: int
 
@@ -35,7 +39,9 @@ class GroupAndStatusModel(BaseModel):
 
 class GroupAndStatusModelList(BaseModel):
     """
-    Модель содержит в себе список GroupAndStatusModel и длину этого списка
+    Модель содержит в себе список GroupAndStatusModel и длину этого списка.
+    next_cursor - group_id последней группы страницы, передаётся в after
+    для получения следующей страницы (None, если страница последняя)
     status codes:
      * 0 - ok
      * 1 - token error
@@ -43,10 +49,14 @@ class GroupAndStatusModelList(BaseModel):
      * 3 - neural network is not ready
      * 4 - microservice error
      * 5 - db error
+     * 6 - generation queue is full
+     * 7 - request rejected by rate limit or overload
+     * 8 - too many items in a batch request
     """
     status: int
     data: list[GroupAndStatusModel]
     count: int
+    next_cursor: Optional[int] = None
 
 
 class DataString(BaseModel):
@@ -59,6 +69,9 @@ class DataString(BaseModel):
      * 3 - neural network is not ready
      * 4 - microservice error
      * 5 - db error
+     * 6 - generation queue is full
+     * 7 - request rejected by rate limit or overload
+     * 8 - too many items in a batch request
     """
     status: int
     data: str
@@ -69,3 +82,85 @@ class GenerateQueryModel(BaseModel):
     service_name: str
     group_id: int
     hint: str
+
+
+class GroupIdListModel(BaseModel):
+    """Модель для пакетного запроса статусов, принимает список айди групп"""
+    group_ids: list[int]
+
+
+class GenerateBatchQueryModel(BaseModel):
+    """Модель для пакетной генерации: список запросов GenerateQueryModel, выполняются параллельно"""
+    items: list[GenerateQueryModel]
+
+
+class DataStringList(BaseModel):
+    """
+    Результат пакетной генерации: в data лежит DataString для каждого запроса
+    в том же порядке, у каждого свой статус. status - статус запроса целиком
+    status codes:
+     * 0 - ok
+     * 1 - token error
+     * 2 - unknown internal exception error
+     * 3 - neural network is not ready
+     * 4 - microservice error
+     * 5 - db error
+     * 6 - generation queue is full
+     * 7 - request rejected by rate limit or overload
+     * 8 - too many items in a batch request
+    """
+    status: int
+    data: list[DataString]
+
+
+class ProfilerCommandModel(BaseModel):
+    """
+    Команда сэмплирующему профилировщику воркера: action - start, stop или
+    status, interval - период снятия стеков в секундах, max_seconds - через
+    сколько секунд профилировщик остановится сам
+    """
+    action: str
+    interval: float = 0.01
+    max_seconds: int = 60
+
+
+class GroupReadyModel(BaseModel):
+    """Модель обратного вызова от микросервиса: группа group_id обучена в сервисе service_name"""
+    group_id: int
+    service_name: str
+
+
+class JobSubmitModel(BaseModel):
+    """
+    Результат постановки задачи генерации в очередь: статус операции и
+    айди задачи (пустой, если задача не создана)
+    status codes:
+     * 0 - ok
+     * 1 - token error
+     * 2 - unknown internal exception error
+     * 3 - neural network is not ready
+     * 4 - microservice error
+     * 5 - db error
+     * 6 - generation queue is full
+     * 7 - request rejected by rate limit or overload
+     * 8 - too many items in a batch request
+    """
+    status: int
+    job_id: str
+
+
+class JobResultModel(BaseModel):
+    """
+    Состояние задачи генерации. В status лежит статус операции, а для
+    завершённой задачи - статус самой генерации (коды как в OperationResult),
+    в data - сгенерированный текст
+    job_status codes:
+     * 0 - queued
+     * 1 - running
+     * 2 - done
+     * 3 - failed
+     * 4 - job not found
+    """
+    status: int
+    job_status: int
+    data: str
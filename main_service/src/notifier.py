@@ -0,0 +1,34 @@
+import asyncio
+
+
+class ReadyNotifier:
+    """
+    Позволяет корутинам дождаться события по ключу (готовность группы,
+    завершение задачи генерации). Работает в пределах одного процесса:
+    ожидающие должны периодически перечитывать состояние из БД
+    """
+
+    def __init__(self):
+        # key -> [event, number of waiters]
+        self.events = {}
+
+    async def wait(self, key, timeout):
+        entry = self.events.get(key)
+        if entry is None:
+            entry = [asyncio.Event(), 0]
+            self.events[key] = entry
+        entry[1] += 1
+        try:
+            await asyncio.wait_for(entry[0].wait(), timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0 and self.events.get(key) is entry:
+                del self.events[key]
+
+    def notify(self, key):
+        entry = self.events.pop(key, None)
+        if entry is not None:
+            entry[0].set()
@@ -0,0 +1,119 @@
+import logging
+import time
+import metrics
+
+
+class PollCycleStats:
+    def __init__(self, total, checked, ready, errors, duration):
+        self.total = total
+        self.checked = checked
+        self.ready = ready
+        self.errors = errors
+        self.duration = duration
+
+
+class GroupStatusPoller:
+    """
+    Опрашивает микросервисы о готовности групп. Проверяются только неготовые
+    группы, одновременно не больше max_in_flight запросов к каждому сервису
+    (пачками через /check_statuses, если сервис это умеет). Если группа всё ещё не
+    готова, следующая её проверка откладывается (интервал удваивается до
+    max_backoff секунд). Изменившиеся статусы пишутся в БД одним запросом.
+    Если воркеров несколько, run_cycle_as_leader выполняет цикл только в
+    том процессе, который держит именованную блокировку LOCK_NAME в MariaDB
+    """
+
+    LOCK_NAME = "strawberry_poller"
+
+    def __init__(self, db, mmgr, max_in_flight=50, base_backoff=10, max_backoff=300,
+                 notifier=None, status_cache=None, log_sample=10):
+        self.db = db
+        self.mmgr = mmgr
+        self.notifier = notifier
+        self.status_cache = status_cache
+        self.max_in_flight = max_in_flight
+        self.base_backoff = base_backoff
+        self.max_backoff = max_backoff
+        # failed checks are logged once per cycle, with at most log_sample group ids
+        self.log_sample = log_sample
+        # group_id -> (monotonic time of next check, current interval)
+        self.schedule = {}
+        self.is_leader = False
+
+    def forget(self, group_id):
+        self.schedule.pop(group_id, None)
+
+    def _is_due(self, group_id, now):
+        entry = self.schedule.get(group_id)
+        return entry is None or entry[0] <= now
+
+    def _back_off(self, group_id, now):
+        entry = self.schedule.get(group_id)
+        interval = self.base_backoff if entry is None else min(
+            entry[1] * 2, self.max_backoff)
+        self.schedule[group_id] = (now + interval, interval)
+
+    async def run_cycle(self):
+        start = time.monotonic()
+        group_ids = await self.db.get_not_ready_groups()
+
+        known = set(group_ids)
+        if self.status_cache is not None:
+            for group_id in group_ids:
+                self.status_cache.set(group_id, 1)
+        for group_id in list(self.schedule):
+            if group_id not in known:
+                del self.schedule[group_id]
+
+        due = [group_id for group_id in group_ids
+               if self._is_due(group_id, start)]
+        results = await self.mmgr.check_statuses(due, self.max_in_flight)
+
+        now = time.monotonic()
+        changed = {}
+        failed = []
+        for group_id in due:
+            result = results.get(group_id)
+            if result is None:
+                failed.append(group_id)
+                self._back_off(group_id, now)
+            elif result:
+                changed[group_id] = 0
+                self.schedule.pop(group_id, None)
+            else:
+                self._back_off(group_id, now)
+
+        await self.db.update_group_statuses(changed)
+        for group_id in changed:
+            if self.status_cache is not None:
+                self.status_cache.set(group_id, 0)
+            if self.notifier is not None:
+                self.notifier.notify(group_id)
+
+        if failed:
+            logging.warning("Group status checks failed", extra={
+                            "failed": len(failed), "sample": failed[:self.log_sample]})
+
+        stats = PollCycleStats(total=len(group_ids), checked=len(due), ready=len(changed),
+                               errors=len(failed), duration=time.monotonic() - start)
+        metrics.POLLER_CYCLE.observe(stats.duration)
+        counts = await self.db.count_groups_by_status()
+        not_ready = sum(count for status_id, count in counts.items()
+                        if status_id != 0)
+        metrics.POLLER_GROUPS.labels("ready").set(counts.get(0, 0))
+        metrics.POLLER_GROUPS.labels("not_ready").set(not_ready)
+        logging.info("Poll cycle", extra={"not_ready": stats.total, "checked": stats.checked, "became_ready": stats.ready,
+                                          "errors": stats.errors, "duration": round(stats.duration, 3)})
+        return stats
+
+    async def run_cycle_as_leader(self):
+        if not await self.db.try_acquire_lock(self.LOCK_NAME):
+            if self.is_leader:
+                logging.info("Poller leadership lost")
+                self.is_leader = False
+                self.schedule = {}
+            return None
+        if not self.is_leader:
+            logging.info("Poller leadership acquired")
+            self.is_leader = True
+        return await self.run_cycle()
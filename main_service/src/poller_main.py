@@ -0,0 +1,66 @@
+"""
+Опрос готовности групп отдельным процессом (poller_mode=external в
+конфиге основного сервиса):
+
+    python poller_main.py [--config /home/config.json] [--metrics-port 9101]
+
+Можно запустить несколько экземпляров: опрос ведёт тот, кто держит
+блокировку в MariaDB, остальные подхватят её при его падении
+"""
+import argparse
+import asyncio
+import logging
+from prometheus_client import start_http_server
+from config import Config
+from logsetup import setup_logging
+from database import Database, AsyncDatabase, DBException
+from microservices import AsyncMicroserviceManager, MicroserviceException
+from poller import GroupStatusPoller
+
+
+async def run(conf):
+    db = AsyncDatabase(Database(conf.db_user, conf.db_password, conf.db_db, conf.db_port, conf.db_host,
+                                pool_size=conf.db_pool_size, max_overflow=conf.db_max_overflow,
+                                pool_recycle=conf.db_pool_recycle, pool_pre_ping=conf.db_pool_pre_ping,
+                                replicas=conf.db_replicas, replica_policy=conf.db_replica_policy,
+                                read_your_writes_window=conf.db_read_your_writes_window),
+                       workers=conf.db_executor_workers)
+    mmgr = AsyncMicroserviceManager(
+        conf.services, conf.http_pool_size, conf.http_keepalive_size,
+        failure_threshold=conf.replica_failure_threshold, eject_seconds=conf.replica_eject_seconds)
+    poller = GroupStatusPoller(db, mmgr, max_in_flight=conf.poller_max_in_flight,
+                               max_backoff=conf.poller_max_backoff, log_sample=conf.poller_log_sample)
+    mmgr.start_health_checks(conf.health_check_interval)
+    try:
+        while True:
+            try:
+                await poller.run_cycle_as_leader()
+            except DBException as exc:
+                logging.error(f"DB ERROR: {exc}")
+            except MicroserviceException as exc:
+                logging.error(f"MICROSERVICE ERROR: {exc}")
+            except Exception as exc:
+                logging.error(f"ERROR: {exc}")
+            await asyncio.sleep(conf.poller_interval)
+    finally:
+        await mmgr.close()
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="/home/config.json")
+    parser.add_argument("--metrics-port", type=int, default=None,
+                        help="serve Prometheus metrics of the poller on this port")
+    args = parser.parse_args()
+
+    conf = Config(args.config)
+    setup_logging(level=conf.log_level,
+                  max_field_length=conf.log_max_field_length)
+    if args.metrics_port is not None:
+        start_http_server(args.metrics_port)
+    asyncio.run(run(conf))
+
+
+if __name__ == "__main__":
+    main()
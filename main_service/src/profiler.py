@@ -0,0 +1,90 @@
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class SamplingProfiler:
+    """
+    Сэмплирующий профилировщик процесса: отдельный поток каждые interval
+    секунд снимает стеки всех потоков через sys._current_frames. Результат -
+    свёрнутые стеки ("поток;функция;... количество"), их понимают
+    flamegraph.pl и speedscope. Останавливается сам через max_seconds
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.thread = None
+        self.stop_event = threading.Event()
+        self.stacks = Counter()
+        self.samples = 0
+        self.started = None
+        self.finished = None
+        self.interval = None
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval=0.01, max_seconds=60):
+        with self.lock:
+            if self.running:
+                return False
+            self.stacks = Counter()
+            self.samples = 0
+            self.started = time.monotonic()
+            self.finished = None
+            self.interval = interval
+            self.stop_event = threading.Event()
+            self.thread = threading.Thread(target=self._run, args=(interval, max_seconds),
+                                           name="sampling-profiler", daemon=True)
+            self.thread.start()
+            return True
+
+    def stop(self):
+        """Останавливает сэмплирование (если оно идёт) и возвращает свёрнутые стеки"""
+        with self.lock:
+            thread = self.thread
+            self.stop_event.set()
+        if thread is not None:
+            thread.join()
+        return self.folded()
+
+    def folded(self):
+        with self.lock:
+            return "\n".join(f"{stack} {count}" for stack, count in self.stacks.most_common())
+
+    def stats(self):
+        with self.lock:
+            return {"pid": os.getpid(), "running": self.running, "samples": self.samples,
+                    "interval": self.interval,
+                    "seconds": round((self.finished or time.monotonic()) - self.started, 3) if self.started else 0}
+
+    def _run(self, interval, max_seconds):
+        own_id = threading.get_ident()
+        deadline = time.monotonic() + max_seconds
+        while not self.stop_event.wait(interval) and time.monotonic() < deadline:
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            frames = sys._current_frames()
+            sample = Counter()
+            for thread_id, frame in frames.items():
+                if thread_id == own_id:
+                    continue
+                sample[_fold(names.get(thread_id, str(thread_id)), frame)] += 1
+            with self.lock:
+                self.stacks.update(sample)
+                self.samples += 1
+        with self.lock:
+            self.finished = time.monotonic()
+
+
+def _fold(thread_name, frame):
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(
+            f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        frame = frame.f_back
+    stack.append(thread_name)
+    return ";".join(reversed(stack))
@@ -0,0 +1,140 @@
+import asyncio
+import time
+from collections import Counter, OrderedDict
+from contextlib import asynccontextmanager
+
+
+class AdmissionRejected(Exception):
+    pass
+
+
+class TokenBucket:
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, count=1):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens +
+                          (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= count:
+            self.tokens -= count
+            return True
+        return False
+
+    def give_back(self, count):
+        self.tokens = min(self.burst, self.tokens + count)
+
+
+class KeyedRateLimiter:
+    """Token bucket на каждый ключ; хранит не больше max_keys последних ключей"""
+
+    def __init__(self, rate, burst, max_keys=100000):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()
+
+    def allow(self, key, count=1):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self.buckets[key] = bucket
+            if len(self.buckets) > self.max_keys:
+                self.buckets.popitem(last=False)
+        else:
+            self.buckets.move_to_end(key)
+        return bucket.take(count)
+
+
+class ConcurrencyLimiter:
+    """
+    Не больше limit одновременных вызовов; ещё max_waiting вызовов могут
+    подождать свободного места до wait_timeout секунд, остальные сразу
+    получают отказ
+    """
+
+    def __init__(self, limit, max_waiting, wait_timeout):
+        self.semaphore = asyncio.Semaphore(limit)
+        self.max_waiting = max_waiting
+        self.wait_timeout = wait_timeout
+        self.waiting = 0
+
+    async def acquire(self):
+        if self.semaphore.locked() and self.waiting >= self.max_waiting:
+            return False
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.semaphore.acquire(), self.wait_timeout)
+            return True
+        except asyncio.TimeoutError:
+            return False
+        finally:
+            self.waiting -= 1
+
+    def release(self):
+        self.semaphore.release()
+
+
+class AdmissionController:
+    """
+    Допуск запросов генерации: token bucket на каждого vk_user_id и на
+    каждый сервис (если для сервиса задан rate_limit), плюс ограничение
+    числа одновременных запросов к сервису с короткой очередью ожидания
+    """
+
+    def __init__(self, services, user_rate, user_burst, wait_timeout):
+        self.users = KeyedRateLimiter(user_rate, user_burst)
+        self.service_buckets = {service.docker_name: TokenBucket(service.rate_limit, service.rate_burst)
+                                for service in services if service.rate_limit}
+        self.service_slots = {service.docker_name: ConcurrencyLimiter(
+            service.max_inflight, service.max_waiting, wait_timeout) for service in services}
+
+    def admit(self, vk_user_id, service_name):
+        bucket = self.service_buckets.get(service_name)
+        if bucket is not None and not bucket.take():
+            raise AdmissionRejected(
+                f"Rate limit exceeded for service {service_name}")
+        if not self.users.allow(vk_user_id):
+            if bucket is not None:
+                bucket.give_back(1)
+            raise AdmissionRejected(
+                f"Rate limit exceeded for user {vk_user_id}")
+
+    def admit_batch(self, vk_user_id, service_names):
+        """Допуск пакета запросов целиком: либо токены есть на все, либо AdmissionRejected"""
+        if not service_names:
+            return
+        taken = []
+        for service_name, count in Counter(service_names).items():
+            bucket = self.service_buckets.get(service_name)
+            if bucket is None:
+                continue
+            if not bucket.take(count):
+                for taken_bucket, taken_count in taken:
+                    taken_bucket.give_back(taken_count)
+                raise AdmissionRejected(
+                    f"Rate limit exceeded for service {service_name}")
+            taken.append((bucket, count))
+        if not self.users.allow(vk_user_id, len(service_names)):
+            for taken_bucket, taken_count in taken:
+                taken_bucket.give_back(taken_count)
+            raise AdmissionRejected(
+                f"Rate limit exceeded for user {vk_user_id} ({len(service_names)} requests)")
+
+    @asynccontextmanager
+    async def slot(self, service_name):
+        limiter = self.service_slots.get(service_name)
+        if limiter is None:
+            # unknown service, the microservice manager reports it
+            yield
+            return
+        if not await limiter.acquire():
+            raise AdmissionRejected(f"Service {service_name} is overloaded")
+        try:
+            yield
+        finally:
+            limiter.release()
@@ -0,0 +1,76 @@
+"""
+Досылает сохранённые корпуса групп в микросервис, например в только что
+развёрнутую реплику:
+
+    python replay_corpus.py --service <docker_name> [--group <group_id>] [--reset]
+    python replay_corpus.py --service <docker_name> --replica http://host:port
+
+--reset забывает, что уже было доставлено сервису, и отправляет всё заново,
+--replica отправляет все корпуса в одну реплику сервиса (например новую)
+"""
+import argparse
+import asyncio
+import logging
+from config import Config
+from database import Database, AsyncDatabase
+from microservices import AsyncMicroserviceManager
+from corpus import CorpusStore
+
+
+async def replay(conf, service_name, group_ids, reset, parallel, replica_url):
+    db = AsyncDatabase(Database(conf.db_user, conf.db_password, conf.db_db, conf.db_port, conf.db_host,
+                                pool_size=conf.db_pool_size, max_overflow=conf.db_max_overflow,
+                                pool_recycle=conf.db_pool_recycle, pool_pre_ping=conf.db_pool_pre_ping),
+                       workers=conf.db_executor_workers)
+    mmgr = AsyncMicroserviceManager(
+        conf.services, conf.http_pool_size, conf.http_keepalive_size)
+    corpus = CorpusStore(db, mmgr)
+    try:
+        if reset and replica_url is None:
+            await db.reset_delivery_watermarks(service_name)
+        if not group_ids:
+            group_ids = await db.get_corpus_group_ids()
+
+        semaphore = asyncio.Semaphore(parallel)
+        total = 0
+
+        async def replay_group(group_id):
+            nonlocal total
+            async with semaphore:
+                if replica_url is None:
+                    sent = (await corpus.sync_group(group_id, [service_name]))[service_name]
+                else:
+                    sent = await corpus.replay_replica(service_name, replica_url, group_id)
+                total += sent
+                logging.info(f"group: {group_id};\tsent: {sent}")
+
+        await asyncio.gather(*[replay_group(group_id) for group_id in group_ids])
+        logging.info(
+            f"Replayed {len(group_ids)} groups, {total} texts to {service_name}")
+    finally:
+        await mmgr.close()
+        db.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", default="/home/config.json")
+    parser.add_argument("--service", required=True,
+                        help="docker_name сервиса из конфига")
+    parser.add_argument("--group", type=int, action="append", default=[],
+                        help="только эти группы (по умолчанию - все)")
+    parser.add_argument("--reset", action="store_true")
+    parser.add_argument("--replica", default=None,
+                        help="адрес реплики вида http://host:port, как в конфиге")
+    parser.add_argument("--parallel", type=int, default=8,
+                        help="сколько групп отправлять одновременно")
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s %(message)s",
+                        datefmt="%I:%M:%S %p", level=logging.INFO)
+    asyncio.run(replay(Config(args.config), args.service,
+                args.group, args.reset, args.parallel, args.replica))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,25 +1,68 @@
+import asyncio
+import json
 import logging
+import os
 import time
 from fastapi.openapi.utils import get_openapi
-from fastapi import FastAPI, Header
+from fastapi import FastAPI, Header, Request
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import Response, StreamingResponse
 from fastapi_utils.tasks import repeat_every
-from utils import is_valid, parse_query_string
+from utils import is_valid, is_valid_internal_signature, is_valid_timed_signature, parse_query_string, iter_ndjson_text_chunks
 from config import Config
-from database import Database, DBException
-from microservices import MicroserviceManager, MicroserviceException
-from models import OperationResult, GroupAddModel, GroupAndStatusModel, GroupAndStatusModelList, DataString, GenerateQueryModel
-
-
-logging.basicConfig(format="%(asctime)s %(message)s", handlers=[logging.FileHandler(
-    f"/home/logs/server_{time.ctime()}.txt", mode="w", encoding="UTF-8")], datefmt="%I:%M:%S %p", level=logging.INFO)
-
-
-conf = Config("/home/config.json")
+from logsetup import setup_logging
+from database import Database, AsyncDatabase, DBException
+from microservices import AsyncMicroserviceManager, MicroserviceException
+from poller import GroupStatusPoller
+from notifier import ReadyNotifier
+from cache import TTLCache, GroupStatusCache
+from jobs import JobQueue, JobQueueFull
+from corpus import CorpusStore
+from ratelimit import AdmissionController, AdmissionRejected
+from profiler import SamplingProfiler
+import tracing
+import metrics
+from models import OperationResult, GroupAddModel, GroupAndStatusModel, GroupAndStatusModelList, DataString, GenerateQueryModel, GenerateBatchQueryModel, DataStringList, GroupIdListModel, GroupReadyModel, ProfilerCommandModel, JobSubmitModel, JobResultModel
+
+
+conf = Config(os.environ.get("STRAWBERRY_CONFIG", "/home/config.json"))
+# one file per worker process, rotated by size
+setup_logging(f"{conf.log_dir}/server_{os.getpid()}.log", level=conf.log_level,
+              max_bytes=conf.log_max_bytes, backup_count=conf.log_backup_count,
+              max_field_length=conf.log_max_field_length)
 app = FastAPI()
-db = Database(conf.db_user, conf.db_password,
-              conf.db_db, conf.db_port, conf.db_host)
-mmgr = MicroserviceManager(conf.services)
+db = AsyncDatabase(Database(conf.db_user, conf.db_password, conf.db_db, conf.db_port, conf.db_host,
+                            pool_size=conf.db_pool_size, max_overflow=conf.db_max_overflow,
+                            pool_recycle=conf.db_pool_recycle, pool_pre_ping=conf.db_pool_pre_ping,
+                            replicas=conf.db_replicas, replica_policy=conf.db_replica_policy,
+                            read_your_writes_window=conf.db_read_your_writes_window),
+                   workers=conf.db_executor_workers)
+mmgr = AsyncMicroserviceManager(
+    conf.services, conf.http_pool_size, conf.http_keepalive_size,
+    generate_cache_size=conf.generate_cache_size, generate_cache_ttl=conf.generate_cache_ttl,
+    failure_threshold=conf.replica_failure_threshold, eject_seconds=conf.replica_eject_seconds)
+notifier = ReadyNotifier()
+status_cache = GroupStatusCache(db, max_size=conf.group_status_cache_size,
+                                not_ready_ttl=conf.group_status_not_ready_ttl)
+poller = GroupStatusPoller(db, mmgr, max_in_flight=conf.poller_max_in_flight,
+                           max_backoff=conf.poller_max_backoff, notifier=notifier,
+                           status_cache=status_cache, log_sample=conf.poller_log_sample)
+job_notifier = ReadyNotifier()
+job_queue = JobQueue(db, mmgr, conf.services, job_notifier)
+corpus = CorpusStore(db, mmgr)
+admission = AdmissionController(conf.services, conf.user_rate_limit, conf.user_rate_burst,
+                                conf.admission_wait_timeout)
+profiler = SamplingProfiler()
+
+# Authorization string -> vk_user_id of launch params with a valid signature
+auth_cache = TTLCache(conf.auth_cache_size, conf.auth_cache_ttl)
+# vk_user_id -> True for users already present in vk_user_ids
+known_users = TTLCache(conf.known_users_cache_size)
+
+WAIT_GROUP_MAX_TIMEOUT = 60
+WAIT_GROUP_DB_RECHECK = 5
+WAIT_JOB_MAX_TIMEOUT = 60
+WAIT_JOB_DB_RECHECK = 5
 
 origins = [
     "https://localhost:10888",
@@ -38,8 +81,28 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["Server-Timing", tracing.REQUEST_ID_HEADER],
 )
 
+
+@app.middleware("http")
+async def stage_timing(request: Request, call_next):
+    '''Корреляционный айди запроса (свой из X-Request-ID или новый) и заголовок Server-Timing с временем этапов auth, db и upstream'''
+    rid = request.headers.get(tracing.REQUEST_ID_HEADER, "")
+    if not rid or len(rid) > 64 or not rid.replace("-", "").isalnum():
+        rid = tracing.new_request_id()
+    tokens = tracing.start_request(rid)
+    start = time.monotonic()
+    try:
+        response = await call_next(request)
+        # for streaming responses this covers the time until the first byte
+        response.headers["Server-Timing"] = tracing.server_timing(
+            time.monotonic() - start)
+        response.headers[tracing.REQUEST_ID_HEADER] = rid
+        return response
+    finally:
+        tracing.finish_request(tokens)
+
 DESCRIPTION = """
 Выпускной проект ОЦ VK в МГТУ команды Team Rattlesnake. Сервис, генерирующий контент для социальной сети ВКонтакте. Посты генерируются сами с помощью нейросетей, также можно сократить текст, перефразировать его и заменить слово на более подходящее. Станьте популярным в сети с помощью Strawberry!
 
@@ -66,10 +129,10 @@ def custom_openapi():
 app.openapi = custom_openapi
 
 
-def add_user(vk_user_id):
+async def add_user(vk_user_id):
     '''Добавляет vk_user_id в базу данных'''
     try:
-        db.add_user_id(vk_user_id)
+        await db.add_user_id(vk_user_id)
         return True
     except DBException:
         return False
@@ -77,37 +140,73 @@ def add_user(vk_user_id):
         return False
 
 
+def verify_authorization(authorization):
+    '''Возвращает vk_user_id, если подпись параметров запуска верна, иначе None'''
+    with tracing.span("auth"):
+        user_id = auth_cache.get(authorization)
+        if user_id is not None:
+            return user_id
+        vk_params_dict = parse_query_string(authorization)
+        if not is_valid(query=vk_params_dict, secret=conf.client_secret):
+            return None
+        user_id = vk_params_dict["vk_user_id"]
+        auth_cache.set(authorization, user_id)
+        return user_id
+
+
+async def ensure_user(vk_user_id):
+    '''Добавляет vk_user_id в базу данных, если его там ещё нет'''
+    if vk_user_id in known_users:
+        return
+    await db.add_user_id(vk_user_id)
+    known_users.set(vk_user_id, True)
+
+
 @app.on_event("startup")
 def startup():
-    '''При старте сервера проверить, все ли таблицы на месте и если нет, то создать'''
+    '''При старте сервера применить недостающие миграции схемы БД'''
     logging.info("Server started")
     try:
-        if not db.tables_exist():
-            logging.info("Creating tables...")
-            db.migrate()
-            logging.info("Creating tables...\tOK")
+        applied = db.db.migrate()
+        if applied:
+            logging.info(f"Applied migrations: {applied}")
+        for vk_user_id in reversed(db.db.get_recent_user_ids(conf.known_users_cache_size)):
+            known_users.set(vk_user_id, True)
     except DBException as exc:
-        logging.info(
+        logging.error(
             "Cannot connect to database, maybe it is still booting... REBOOT NOW!")
         raise Exception(
             "Rebooting and hoping database will be online...") from exc
 
 
 @app.on_event("startup")
-@repeat_every(seconds=10)
+async def start_jobs():
+    '''Запускает проверки здоровья реплик микросервисов, досылку корпусов отставшим репликам, обработчики очереди задач генерации и возвращает в очередь незавершённые задачи'''
+    mmgr.start_health_checks(conf.health_check_interval)
+    corpus.start_catch_up(conf.health_check_interval)
+    job_queue.start()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    '''При остановке сервера остановить очередь задач, закрыть пулы соединений с микросервисами и БД'''
+    await job_queue.stop()
+    await corpus.stop_catch_up()
+    await mmgr.close()
+    db.close()
+
+
+@app.on_event("startup")
+@repeat_every(seconds=conf.poller_interval)
 async def check_statuses():
-    '''Автоматическое удаление старых токенов и обновление статусов пабликов'''
-    try:
-        logging.info("Updating groups statuses...")
-        groups = db.get_all_groups()
-        for group in groups:
-            if mmgr.check_status(group.group_id):
-                logging.error(f"group: {group.group_id};\tstatus: READY")
-                db.update_group_status(group.group_id, 0)
-            else:
-                logging.error(f"group: {group.group_id};\tstatus: NOT READY")
-                db.update_group_status(group.group_id, 1)
-        logging.info("Updating groups statuses...\tOK")
+    '''Обновление статусов пабликов. При нескольких воркерах опрос ведёт только один из них (poller_mode=leader) либо отдельный процесс poller_main.py (poller_mode=external)'''
+    try:
+        if conf.poller_mode == "external":
+            return
+        if conf.poller_mode == "every":
+            await poller.run_cycle()
+        else:
+            await poller.run_cycle_as_leader()
     except DBException as exc:
         logging.error(f"DB ERROR: {exc}")
     except MicroserviceException as exc:
@@ -117,27 +216,61 @@ async def check_statuses():
 
 
 @app.post("/add_group", response_model=OperationResult)
+@metrics.observe_route("/add_group")
 async def add_group(data: GroupAddModel, Authorization=Header()):
-    '''Добавляет айди группы в базу данных и отправляет массив текстов постов этой группы'''
+    '''Добавляет айди группы в базу данных, сохраняет тексты постов этой группы и досылает в микросервисы те, которых у них ещё нет'''
 
     group_id = data.group_id
     texts = data.texts
-    vk_params_dict = parse_query_string(Authorization)
-    user_id = vk_params_dict["vk_user_id"]
+    user_id = verify_authorization(Authorization)
 
     logging.info(
-        f"POST /add_group\tPARAMS: Authorization={Authorization[:16]}..., len_texts={len(texts)}, group_id={group_id}")
+        "POST /add_group", extra={"auth": Authorization[:16], "len_texts": len(texts), "group_id": group_id})
     try:
-        if not is_valid(query=vk_params_dict, secret=conf.client_secret):
-            logging.error("/add_group query is not valid")
+        if user_id is None:
+            logging.warning("/add_group query is not valid")
             return OperationResult(status=1)
 
-        if not db.is_valid_user_id(user_id):
-            db.add_user_id(user_id)
+        # db.add_group also upserts the user
+        status_cache.set(group_id, await db.add_group(group_id, user_id))
+        known_users.set(user_id, True)
+        await corpus.store(group_id, texts)
+        sent = await corpus.sync_group(group_id)
+        logging.debug(f"/add_group OK sent={sent}")
+        return OperationResult(status=0)
+    except MicroserviceException as exc:
+        logging.error(f"MICROSERVICE ERROR: {exc}")
+        return OperationResult(status=4)
+    except DBException as exc:
+        logging.error(f"DB ERROR: {exc}")
+        return OperationResult(status=5)
+    except Exception as exc:
+        logging.error(f"ERROR: {exc}")
+        return OperationResult(status=2)
+
+
+@app.post("/add_group_stream", response_model=OperationResult)
+@metrics.observe_route("/add_group_stream")
+async def add_group_stream(group_id: int, request: Request, Authorization=Header(), Content_Encoding: str = Header(default="")):
+    '''Потоковый вариант /add_group: тело - NDJSON (по JSON-строке с текстом поста на строку), можно сжать gzip с заголовком Content-Encoding: gzip. Тексты сохраняются в БД и досылаются в микросервисы частями, не собираясь в памяти целиком'''
+    user_id = verify_authorization(Authorization)
+
+    logging.info(
+        "POST /add_group_stream", extra={"auth": Authorization[:16], "group_id": group_id, "encoding": Content_Encoding})
+    try:
+        if user_id is None:
+            logging.warning("/add_group_stream query is not valid")
+            return OperationResult(status=1)
 
-        db.add_group(group_id, user_id)
-        mmgr.add_group(group_id, texts)
-        logging.info("/add_group OK")
+        status_cache.set(group_id, await db.add_group(group_id, user_id))
+        known_users.set(user_id, True)
+        total = 0
+        async for texts in iter_ndjson_text_chunks(request.stream(), gzipped=Content_Encoding.lower() == "gzip"):
+            await corpus.store(group_id, texts)
+            total += len(texts)
+        sent = await corpus.sync_group(group_id)
+        logging.debug(
+            f"/add_group_stream OK len_texts={total}, sent={sent}")
         return OperationResult(status=0)
     except MicroserviceException as exc:
         logging.error(f"MICROSERVICE ERROR: {exc}")
@@ -151,28 +284,27 @@ async def add_group(data: GroupAddModel, Authorization=Header()):
 
 
 @app.get("/get_groups", response_model=GroupAndStatusModelList)
-async def get_groups(group_id: int = None, offset: int = None, count: int = None, Authorization=Header()):
-    '''Возвращает массив пар айди группы : статус'''
-    vk_params_dict = parse_query_string(Authorization)
-    user_id = vk_params_dict["vk_user_id"]
+@metrics.observe_route("/get_groups")
+async def get_groups(group_id: int = None, offset: int = None, count: int = None, after: int = None, Authorization=Header()):
+    '''Возвращает массив пар айди группы : статус. Страница задаётся count и offset либо курсором after (next_cursor предыдущей страницы)'''
+    user_id = verify_authorization(Authorization)
 
     logging.info(
-        f"GET /get_groups\tPARAMS: Authorization={Authorization[:16]}..., group_id={group_id}, offset={offset}, count={count}")
-    if not is_valid(query=vk_params_dict, secret=conf.client_secret):
-        logging.error("/get_groups query is not valid")
+        "GET /get_groups", extra={"auth": Authorization[:16], "group_id": group_id, "offset": offset, "count": count, "after": after})
+    if user_id is None:
+        logging.warning("/get_groups query is not valid")
         return GroupAndStatusModelList(status=1, data=[], count=0)
 
     try:
-        if not db.is_valid_user_id(user_id):
-            db.add_user_id(user_id)
+        await ensure_user(user_id)
     except DBException as exc:
         logging.error(f"DB ERROR: {exc}")
         return GroupAndStatusModelList(status=5, data=[], count=0)
 
     if not group_id is None:
         try:
-            result = db.get_group_status(group_id)
-            logging.info("/get_groups OK")
+            result = await status_cache.get(group_id)
+            logging.debug("/get_groups OK")
             return GroupAndStatusModelList(status=0, data=[GroupAndStatusModel(group_id=group_id, group_status=result)], count=1)
         except DBException as exc:
             logging.error(f"DB ERROR: {exc}")
@@ -182,12 +314,17 @@ async def get_groups(group_id: int = None, offset: int = None, count: int = None
             return GroupAndStatusModelList(status=2, data=[], count=0)
     else:
         try:
-            result = db.get_owned_groups(user_id)
-            total_len = len(result)
-            if (not offset is None) and (not count is None):
-                result = result[offset:offset+count]
-                logging.info("/get_groups OK")
-            return GroupAndStatusModelList(status=0, data=result, count=total_len)
+            if count is None:
+                offset = None
+            # the list must include groups the user has just added through
+            # any worker, and sticky keys are per process, so read the primary
+            result, total_len = await db.get_owned_groups(
+                user_id, offset=offset, count=count, after=after, primary=True)
+            next_cursor = None
+            if count is not None and len(result) == count and len(result) > 0:
+                next_cursor = result[-1].group_id
+            logging.debug("/get_groups OK")
+            return GroupAndStatusModelList(status=0, data=result, count=total_len, next_cursor=next_cursor)
         except DBException as exc:
             logging.error(f"DB ERROR: {exc}")
             return GroupAndStatusModelList(status=5, data=[], count=0)
@@ -196,34 +333,68 @@ async def get_groups(group_id: int = None, offset: int = None, count: int = None
             return GroupAndStatusModelList(status=2, data=[], count=0)
 
 
+@app.post("/get_group_statuses", response_model=GroupAndStatusModelList)
+@metrics.observe_route("/get_group_statuses")
+async def get_group_statuses(data: GroupIdListModel, Authorization=Header()):
+    '''Возвращает статусы сразу нескольких групп, отсутствующие в кэше читаются из БД одним запросом. Повторяющиеся айди возвращаются один раз, айди не больше batch_max_groups'''
+    user_id = verify_authorization(Authorization)
+    group_ids = list(dict.fromkeys(data.group_ids))
+
+    logging.info(
+        "POST /get_group_statuses", extra={"auth": Authorization[:16], "len_group_ids": len(group_ids)})
+    if user_id is None:
+        logging.warning("/get_group_statuses query is not valid")
+        return GroupAndStatusModelList(status=1, data=[], count=0)
+    if len(group_ids) > conf.batch_max_groups:
+        logging.warning("/get_group_statuses batch is too large")
+        return GroupAndStatusModelList(status=8, data=[], count=0)
+
+    try:
+        await ensure_user(user_id)
+        statuses = await status_cache.get_many(group_ids)
+        logging.debug("/get_group_statuses OK")
+        return GroupAndStatusModelList(status=0, data=[GroupAndStatusModel(group_id=group_id, group_status=statuses[group_id])
+                                                       for group_id in group_ids], count=len(group_ids))
+    except DBException as exc:
+        logging.error(f"DB ERROR: {exc}")
+        return GroupAndStatusModelList(status=5, data=[], count=0)
+    except Exception as exc:
+        logging.error(f"ERROR: {exc}")
+        return GroupAndStatusModelList(status=2, data=[], count=0)
+
+
 @app.post("/generate", response_model=DataString)
+@metrics.observe_route("/generate")
 async def generate(data: GenerateQueryModel, Authorization=Header()):
     '''Генерирует текст по описанию hint'''
 
-    vk_params_dict = parse_query_string(Authorization)
+    user_id = verify_authorization(Authorization)
     service_name = data.service_name
     group_id = data.group_id
     hint = data.hint
-    user_id = vk_params_dict["vk_user_id"]
 
     logging.info(
-        f"POST /generate\tPARAMS: Authorization={Authorization[:16]}..., service_name={service_name}, group_id={group_id}, hint={hint}")
+        "POST /generate", extra={"auth": Authorization[:16], "service_name": service_name, "group_id": group_id, "len_hint": len(hint)})
 
-    if not is_valid(query=vk_params_dict, secret=conf.client_secret):
-        logging.info("/generate query is not valid")
+    if user_id is None:
+        logging.warning("/generate query is not valid")
         return DataString(data="", status=1)
 
     try:
-        if not db.is_valid_user_id(user_id):
-            db.add_user_id(user_id)
+        await ensure_user(user_id)
 
-        group_status = db.get_group_status(group_id)
+        group_status = await status_cache.get(group_id)
         if group_status == 0:
-            result = mmgr.generate(service_name, group_id, hint)
-            logging.info("/generate OK")
+            admission.admit(user_id, service_name)
+            async with admission.slot(service_name):
+                result = await mmgr.generate(service_name, group_id, hint)
+            logging.debug("/generate OK")
             return DataString(data=result, status=0)
-        logging.error("/generate group not ready")
+        logging.warning("/generate group not ready")
         return DataString(data="", status=3)
+    except AdmissionRejected as exc:
+        logging.warning(f"SHED: {exc}")
+        return DataString(data="", status=7)
     except MicroserviceException as exc:
         logging.error(f"MICROSERVICE ERROR: {exc}")
         return DataString(data="", status=4)
@@ -233,3 +404,312 @@ async def generate(data: GenerateQueryModel, Authorization=Header()):
     except Exception as exc:
         logging.error(f"ERROR: {exc}")
         return DataString(data="", status=2)
+
+
+async def generate_item(item, group_status):
+    '''Один запрос /generate_batch, ошибка превращается в статус этого запроса'''
+    try:
+        if group_status != 0:
+            return DataString(data="", status=3)
+        async with admission.slot(item.service_name):
+            result = await mmgr.generate(item.service_name, item.group_id, item.hint)
+        return DataString(data=result, status=0)
+    except AdmissionRejected as exc:
+        logging.warning(f"SHED: {exc}")
+        return DataString(data="", status=7)
+    except MicroserviceException as exc:
+        logging.error(f"MICROSERVICE ERROR: {exc}")
+        return DataString(data="", status=4)
+    except Exception as exc:
+        logging.error(f"ERROR: {exc}")
+        return DataString(data="", status=2)
+
+
+@app.post("/generate_batch", response_model=DataStringList)
+@metrics.observe_route("/generate_batch")
+async def generate_batch(data: GenerateBatchQueryModel, Authorization=Header()):
+    '''Выполняет несколько запросов генерации параллельно. Подпись и пользователь проверяются один раз, статусы групп читаются одним запросом. Пакет допускается ограничением частоты целиком (по токену на каждую готовую группу) либо отклоняется со статусом 7. Результаты в порядке запросов, у каждого свой статус; запросов не больше batch_max_generate'''
+    user_id = verify_authorization(Authorization)
+    items = data.items
+
+    logging.info(
+        "POST /generate_batch", extra={"auth": Authorization[:16], "len_items": len(items)})
+    if user_id is None:
+        logging.warning("/generate_batch query is not valid")
+        return DataStringList(status=1, data=[])
+    if len(items) > conf.batch_max_generate:
+        logging.warning("/generate_batch batch is too large")
+        return DataStringList(status=8, data=[])
+
+    try:
+        await ensure_user(user_id)
+        statuses = await status_cache.get_many(list({item.group_id for item in items}))
+        # rate limit tokens only for the items that will be generated
+        admission.admit_batch(user_id, [item.service_name for item in items
+                                        if statuses[item.group_id] == 0])
+        results = await asyncio.gather(*[generate_item(item, statuses[item.group_id])
+                                         for item in items])
+        logging.debug("/generate_batch OK")
+        return DataStringList(status=0, data=results)
+    except AdmissionRejected as exc:
+        logging.warning(f"SHED: {exc}")
+        return DataStringList(status=7, data=[])
+    except DBException as exc:
+        logging.error(f"DB ERROR: {exc}")
+        return DataStringList(status=5, data=[])
+    except Exception as exc:
+        logging.error(f"ERROR: {exc}")
+        return DataStringList(status=2, data=[])
+
+
+def sse_event(status, data="", done=False):
+    '''Одно событие text/event-stream с DataString внутри'''
+    payload = DataString(status=status, data=data).dict()
+    payload["done"] = done
+    if done:
+        metrics.observe_result("/generate_stream", status)
+    return f"data: {json.dumps(payload, ensure_ascii=False)}\n\n"
+
+
+@app.post("/generate_stream")
+async def generate_stream(data: GenerateQueryModel, Authorization=Header()):
+    '''Генерирует текст по описанию hint и отдаёт его по частям через text/event-stream. Каждое событие - DataString с полем done, последнее событие имеет done=true'''
+    user_id = verify_authorization(Authorization)
+    service_name = data.service_name
+    group_id = data.group_id
+    hint = data.hint
+
+    logging.info(
+        "POST /generate_stream", extra={"auth": Authorization[:16], "service_name": service_name, "group_id": group_id, "len_hint": len(hint)})
+
+    async def events():
+        start = time.monotonic()
+        if user_id is None:
+            logging.warning("/generate_stream query is not valid")
+            yield sse_event(1, done=True)
+            return
+        first_chunk = True
+        try:
+            await ensure_user(user_id)
+            if await status_cache.get(group_id) != 0:
+                logging.warning("/generate_stream group not ready")
+                yield sse_event(3, done=True)
+                return
+            admission.admit(user_id, service_name)
+            async with admission.slot(service_name):
+                async for chunk in mmgr.generate_stream(service_name, group_id, hint):
+                    if first_chunk:
+                        first_chunk = False
+                        metrics.GENERATE_FIRST_CHUNK.observe(
+                            time.monotonic() - start)
+                        logging.info(
+                            f"/generate_stream first chunk after {time.monotonic() - start:.3f}s")
+                    yield sse_event(0, chunk)
+            logging.debug(
+                f"/generate_stream OK in {time.monotonic() - start:.3f}s")
+            yield sse_event(0, done=True)
+        except AdmissionRejected as exc:
+            logging.warning(f"SHED: {exc}")
+            yield sse_event(7, done=True)
+        except MicroserviceException as exc:
+            logging.error(f"MICROSERVICE ERROR: {exc}")
+            yield sse_event(4, done=True)
+        except DBException as exc:
+            logging.error(f"DB ERROR: {exc}")
+            yield sse_event(5, done=True)
+        except Exception as exc:
+            logging.error(f"ERROR: {exc}")
+            yield sse_event(2, done=True)
+        finally:
+            # whole stream, the handler itself returns before generation starts
+            metrics.ROUTE_LATENCY.labels(
+                "/generate_stream").observe(time.monotonic() - start)
+
+    return StreamingResponse(events(), media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+
+@app.post("/internal/group_ready", response_model=OperationResult)
+@metrics.observe_route("/internal/group_ready")
+async def group_ready(request: Request, X_Signature: str = Header(default="")):
+    '''Обратный вызов от микросервиса: группа обучена. Тело запроса подписывается HMAC-SHA256 на internal_secret, подпись передаётся в заголовке X-Signature'''
+    body = await request.body()
+    if not is_valid_internal_signature(body=body, signature=X_Signature, secret=conf.internal_secret):
+        logging.warning("/internal/group_ready signature is not valid")
+        return OperationResult(status=1)
+
+    try:
+        data = GroupReadyModel.parse_raw(body)
+        logging.info(
+            "POST /internal/group_ready", extra={"group_id": data.group_id, "service_name": data.service_name})
+        statuses = await mmgr.check_statuses([data.group_id])
+        if statuses.get(data.group_id):
+            await db.update_group_statuses({data.group_id: 0})
+            status_cache.set(data.group_id, 0)
+            poller.forget(data.group_id)
+            notifier.notify(data.group_id)
+            logging.info(f"/internal/group_ready group {data.group_id} READY")
+        return OperationResult(status=0)
+    except DBException as exc:
+        logging.error(f"DB ERROR: {exc}")
+        return OperationResult(status=5)
+    except Exception as exc:
+        logging.error(f"ERROR: {exc}")
+        return OperationResult(status=2)
+
+
+@app.get("/internal/stats")
+async def internal_stats(request: Request, X_Signature: str = Header(default=""), X_Timestamp: str = Header(default="")):
+    '''Счётчики кэша и объединения запросов генерации, состояние реплик микросервисов. X-Timestamp - текущее unix-время в секундах, X-Signature - HMAC-SHA256 строки "<путь запроса>\\n<X-Timestamp>" на internal_secret'''
+    if not is_valid_timed_signature(body=request.url.path.encode(), timestamp=X_Timestamp, signature=X_Signature,
+                                    secret=conf.internal_secret, window=conf.internal_signature_window):
+        logging.warning("/internal/stats signature is not valid")
+        return {"status": 1}
+    return {"status": 0, "generate": mmgr.generate_stats(), "replicas": mmgr.replica_stats()}
+
+
+@app.post("/internal/profiler")
+async def internal_profiler(request: Request, X_Signature: str = Header(default="")):
+    '''Включает (start) и выключает (stop) сэмплирующий профилировщик воркера, который принял запрос; stop возвращает свёрнутые стеки для flamegraph. Тело - ProfilerCommandModel, X-Signature - HMAC-SHA256 тела на internal_secret'''
+    body = await request.body()
+    if not is_valid_internal_signature(body=body, signature=X_Signature, secret=conf.internal_secret):
+        logging.warning("/internal/profiler signature is not valid")
+        return {"status": 1}
+    try:
+        command = ProfilerCommandModel.parse_raw(body)
+        logging.info("POST /internal/profiler", extra={"action": command.action,
+                     "interval": command.interval, "max_seconds": command.max_seconds})
+        if command.action == "start":
+            started = profiler.start(max(command.interval, 0.001), command.max_seconds)
+            return {"status": 0, "started": started, **profiler.stats()}
+        if command.action == "stop":
+            stacks = profiler.stop()
+            return {"status": 0, **profiler.stats(), "stacks": stacks}
+        return {"status": 0, **profiler.stats()}
+    except Exception as exc:
+        logging.error(f"ERROR: {exc}")
+        return {"status": 2}
+
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    '''Метрики в формате Prometheus: время ответа и статусы ручек, вызовы микросервисов и БД, циклы опроса готовности групп'''
+    body, content_type = metrics.render()
+    return Response(content=body, media_type=content_type)
+
+
+@app.get("/wait_group", response_model=GroupAndStatusModelList)
+@metrics.observe_route("/wait_group")
+async def wait_group(group_id: int, timeout: int = 30, Authorization=Header()):
+    '''Long-poll: ждёт до timeout секунд (не больше 60), пока группа станет готовой, и возвращает её статус'''
+    user_id = verify_authorization(Authorization)
+
+    logging.info(
+        "GET /wait_group", extra={"auth": Authorization[:16], "group_id": group_id, "timeout": timeout})
+    if user_id is None:
+        logging.warning("/wait_group query is not valid")
+        return GroupAndStatusModelList(status=1, data=[], count=0)
+
+    try:
+        deadline = time.monotonic() + min(max(timeout, 0), WAIT_GROUP_MAX_TIMEOUT)
+        status = await status_cache.get(group_id)
+        while status == 1:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # the poller may run in another worker, so the DB is re-read periodically
+            if not await notifier.wait(group_id, min(remaining, WAIT_GROUP_DB_RECHECK)):
+                status_cache.forget(group_id)
+            status = await status_cache.get(group_id)
+        logging.debug("/wait_group OK")
+        return GroupAndStatusModelList(status=0, data=[GroupAndStatusModel(group_id=group_id, group_status=status)], count=1)
+    except DBException as exc:
+        logging.error(f"DB ERROR: {exc}")
+        return GroupAndStatusModelList(status=5, data=[], count=0)
+    except Exception as exc:
+        logging.error(f"ERROR: {exc}")
+        return GroupAndStatusModelList(status=2, data=[], count=0)
+
+
+@app.post("/jobs/generate", response_model=JobSubmitModel)
+@metrics.observe_route("/jobs/generate")
+async def submit_generate_job(data: GenerateQueryModel, Authorization=Header()):
+    '''Ставит генерацию текста по описанию hint в очередь и сразу возвращает айди задачи'''
+    user_id = verify_authorization(Authorization)
+    service_name = data.service_name
+    group_id = data.group_id
+
+    logging.info(
+        "POST /jobs/generate", extra={"auth": Authorization[:16], "service_name": service_name, "group_id": group_id, "len_hint": len(data.hint)})
+    if user_id is None:
+        logging.warning("/jobs/generate query is not valid")
+        return JobSubmitModel(status=1, job_id="")
+
+    try:
+        await ensure_user(user_id)
+
+        if await status_cache.get(group_id) != 0:
+            logging.warning("/jobs/generate group not ready")
+            return JobSubmitModel(status=3, job_id="")
+        admission.admit(user_id, service_name)
+        job_id = await job_queue.submit(user_id, service_name, group_id, data.hint)
+        logging.debug(f"/jobs/generate OK job_id={job_id}")
+        return JobSubmitModel(status=0, job_id=job_id)
+    except AdmissionRejected as exc:
+        logging.warning(f"SHED: {exc}")
+        return JobSubmitModel(status=7, job_id="")
+    except JobQueueFull as exc:
+        logging.error(f"QUEUE FULL: {exc}")
+        return JobSubmitModel(status=6, job_id="")
+    except MicroserviceException as exc:
+        logging.error(f"MICROSERVICE ERROR: {exc}")
+        return JobSubmitModel(status=4, job_id="")
+    except DBException as exc:
+        logging.error(f"DB ERROR: {exc}")
+        return JobSubmitModel(status=5, job_id="")
+    except Exception as exc:
+        logging.error(f"ERROR: {exc}")
+        return JobSubmitModel(status=2, job_id="")
+
+
+async def load_job(route, job_id, timeout, authorization):
+    '''Общая часть /jobs/get и /jobs/wait: ждёт до timeout секунд завершения задачи'''
+    user_id = verify_authorization(authorization)
+
+    logging.info(
+        f"GET {route}", extra={"auth": authorization[:16], "job_id": job_id, "timeout": timeout})
+    if user_id is None:
+        logging.warning(f"{route} query is not valid")
+        return JobResultModel(status=1, job_status=4, data="")
+
+    try:
+        deadline = time.monotonic() + min(max(timeout, 0), WAIT_JOB_MAX_TIMEOUT)
+        job = await db.get_job(job_id, user_id)
+        while job.job_status in (0, 1):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            # the job may run in another worker, so the DB is re-read periodically
+            await job_notifier.wait(job_id, min(remaining, WAIT_JOB_DB_RECHECK))
+            job = await db.get_job(job_id, user_id)
+        return job
+    except DBException as exc:
+        logging.error(f"DB ERROR: {exc}")
+        return JobResultModel(status=5, job_status=4, data="")
+    except Exception as exc:
+        logging.error(f"ERROR: {exc}")
+        return JobResultModel(status=2, job_status=4, data="")
+
+
+@app.get("/jobs/get", response_model=JobResultModel)
+@metrics.observe_route("/jobs/get")
+async def get_job(job_id: str, Authorization=Header()):
+    '''Возвращает состояние задачи генерации и результат, если она завершена'''
+    return await load_job("/jobs/get", job_id, 0, Authorization)
+
+
+@app.get("/jobs/wait", response_model=JobResultModel)
+@metrics.observe_route("/jobs/wait")
+async def wait_job(job_id: str, timeout: int = 30, Authorization=Header()):
+    '''Long-poll: ждёт до timeout секунд (не больше 60) завершения задачи генерации и возвращает её состояние'''
+    return await load_job("/jobs/wait", job_id, timeout, Authorization)
@@ -0,0 +1,60 @@
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+
+# correlation id of the request being handled, forwarded to microservices
+request_id = ContextVar("request_id", default=None)
+# stage -> [seconds, calls] of the request being handled, None outside requests
+_spans = ContextVar("spans", default=None)
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+
+def new_request_id():
+    return uuid.uuid4().hex
+
+
+def start_request(rid):
+    """Начинает учёт этапов запроса в текущем контексте, возвращает токены для finish_request"""
+    return request_id.set(rid), _spans.set({})
+
+
+def finish_request(tokens):
+    request_id.reset(tokens[0])
+    _spans.reset(tokens[1])
+
+
+@contextmanager
+def span(stage):
+    """
+    Добавляет время блока к этапу stage текущего запроса. Задачи, созданные
+    внутри запроса (asyncio.gather), пишут в тот же словарь, поэтому время
+    параллельных вызовов складывается
+    """
+    spans = _spans.get()
+    if spans is None:
+        yield
+        return
+    start = time.monotonic()
+    try:
+        yield
+    finally:
+        entry = spans.setdefault(stage, [0.0, 0])
+        entry[0] += time.monotonic() - start
+        entry[1] += 1
+
+
+def outgoing_headers():
+    """Заголовки для вызова микросервиса: корреляционный айди, если он есть"""
+    rid = request_id.get()
+    return {} if rid is None else {REQUEST_ID_HEADER: rid}
+
+
+def server_timing(total):
+    """Значение заголовка Server-Timing: этапы текущего запроса и total, в миллисекундах"""
+    parts = [f'{stage};dur={seconds * 1000:.1f};desc="{calls} calls"'
+             for stage, (seconds, calls) in (_spans.get() or {}).items()]
+    parts.append(f"total;dur={total * 1000:.1f}")
+    return ", ".join(parts)
@@ -1,7 +1,10 @@
+import json
+import time
+import zlib
 from base64 import b64encode
 from collections import OrderedDict
 from hashlib import sha256
-from hmac import HMAC
+from hmac import HMAC, compare_digest
 from urllib.parse import urlencode
 
 
@@ -20,3 +23,70 @@ def parse_query_string(query_string):
     res = dict([pair.split("=") for pair in query_string.split("&")])
     res["vk_user_id"] = int(res["vk_user_id"])
     return res
+
+
+def is_valid_internal_signature(*, body: bytes, signature: str, secret: str) -> bool:
+    """Check HMAC-SHA256 signature of internal (microservice to main service) calls"""
+    if not secret or not signature:
+        return False
+    expected = HMAC(secret.encode(), body, sha256).hexdigest()
+    return compare_digest(expected, signature)
+
+
+def is_valid_timed_signature(*, body: bytes, timestamp: str, signature: str, secret: str, window: float) -> bool:
+    """
+    Check HMAC-SHA256 signature of body + b"\n" + timestamp, where timestamp
+    is unix time in seconds no further than window seconds from now, so a
+    captured signature stops working shortly after it was made
+    """
+    try:
+        age = abs(time.time() - int(timestamp))
+    except ValueError:
+        return False
+    if age > window:
+        return False
+    return is_valid_internal_signature(body=body + b"\n" + timestamp.encode(), signature=signature, secret=secret)
+
+
+async def iter_ndjson_text_chunks(stream, *, gzipped: bool, chunk_bytes: int = 1 << 20, max_line_bytes: int = 16 << 20):
+    """
+    Read NDJSON (one JSON string per line, optionally gzip'd) from an async
+    byte stream and yield lists of texts of about chunk_bytes each, so memory
+    use does not depend on the size of the whole body
+    """
+    decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16) if gzipped else None
+    buffer = b""
+    texts, size = [], 0
+
+    def parse(lines):
+        nonlocal size
+        for line in lines:
+            if not line.strip():
+                continue
+            text = json.loads(line)
+            if not isinstance(text, str):
+                raise ValueError("Every NDJSON line must be a JSON string")
+            texts.append(text)
+            size += len(line)
+
+    async for data in stream:
+        while data:
+            if decompressor is None:
+                piece, data = data, b""
+            else:
+                piece = decompressor.decompress(data, chunk_bytes)
+                data = decompressor.unconsumed_tail
+            buffer += piece
+            *lines, buffer = buffer.split(b"\n")
+            if len(buffer) > max_line_bytes:
+                raise ValueError("NDJSON line is too long")
+            parse(lines)
+            if size >= chunk_bytes:
+                yield texts
+                texts, size = [], 0
+
+    if decompressor is not None:
+        buffer += decompressor.flush()
+    parse(buffer.split(b"\n"))
+    if texts:
+        yield texts
@@ -0,0 +1,61 @@
+"""
+Сравнивает опрос готовности групп пачками и по одной группе на локальной
+заглушке микросервиса.
+
+    STUB_TRAIN_SECONDS=0 uvicorn --app-dir stub_service/src --port 15000 server:app
+    STUB_TRAIN_SECONDS=0 STUB_BATCH=0 uvicorn --app-dir stub_service/src --port 15001 server:app
+    python stub_service/src/measure_polling.py --groups 5000 \\
+        --service http://localhost:15000 --service http://localhost:15001
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+import httpx
+
+sys.path.insert(0, os.path.join(os.path.dirname(
+    os.path.abspath(__file__)), "..", "..", "main_service", "src"))
+
+from config import MicroserviceData  # noqa: E402
+from microservices import AsyncMicroserviceManager  # noqa: E402
+
+
+async def measure(services, groups):
+    mmgr = AsyncMicroserviceManager(services)
+    group_ids = list(range(1, groups + 1))
+    async with httpx.AsyncClient() as client:
+        for service in services:
+            base = f"{service.url}:{service.port}"
+            await asyncio.gather(*[client.post(f"{base}/add_group", json={"group_id": group_id, "texts": []})
+                                   for group_id in group_ids])
+            await client.post(f"{base}/reset_stats")
+
+        start = time.monotonic()
+        statuses = await mmgr.check_statuses(group_ids)
+        duration = time.monotonic() - start
+
+        print(f"groups: {groups}, ready: {sum(statuses.values())}, duration: {duration:.3f}s")
+        for service in services:
+            response = await client.get(f"{service.url}:{service.port}/stats")
+            print(f"{service.docker_name}: {response.json()['result']}")
+    await mmgr.close()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--groups", type=int, default=1000)
+    parser.add_argument("--service", action="append", required=True,
+                        help="адрес заглушки вида http://localhost:15000")
+    args = parser.parse_args()
+
+    services = []
+    for i, address in enumerate(args.service):
+        url, port = address.rsplit(":", 1)
+        services.append(MicroserviceData(
+            {f"stub{i}": {"docker_name": f"stub{i}", "url": url, "port": int(port)}}))
+    asyncio.run(measure(services, args.groups))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+import asyncio
+import json
+import os
+import random
+import time
+from collections import Counter
+from hashlib import sha256
+from hmac import HMAC
+import httpx
+from fastapi import FastAPI
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel
+
+
+TRAIN_SECONDS = float(os.environ.get("STUB_TRAIN_SECONDS", "30"))
+SUPPORTS_BATCH = os.environ.get("STUB_BATCH", "1") == "1"
+SERVICE_NAME = os.environ.get("STUB_SERVICE_NAME", "stub")
+# e.g. http://main_server:14565/internal/group_ready, empty - no callbacks
+CALLBACK_URL = os.environ.get("STUB_CALLBACK_URL", "")
+CALLBACK_SECRET = os.environ.get("STUB_CALLBACK_SECRET", "")
+TOKEN_DELAY = float(os.environ.get("STUB_TOKEN_DELAY", "0.05"))
+# simulated model latency: uniform in [STUB_LATENCY, STUB_LATENCY + STUB_LATENCY_JITTER]
+# seconds for /generate, /add_group and /add_group_chunk, a tenth of it for
+# status checks; STUB_FAILURE_RATE of those calls answer {"result": "ERROR"}
+LATENCY = float(os.environ.get("STUB_LATENCY", "0"))
+LATENCY_JITTER = float(os.environ.get("STUB_LATENCY_JITTER", "0"))
+FAILURE_RATE = float(os.environ.get("STUB_FAILURE_RATE", "0"))
+
+
+class AddGroupModel(BaseModel):
+    group_id: int
+    texts: list[str]
+
+
+class AddGroupChunkModel(BaseModel):
+    group_id: int
+    texts: list[str]
+    seq: int
+    last: bool
+
+
+class GenerateModel(BaseModel):
+    group_id: int
+    hint: str
+
+
+class CheckStatusesModel(BaseModel):
+    group_ids: list[int]
+
+
+app = FastAPI()
+ready_at = {}
+requests_count = Counter()
+callback_tasks = set()
+
+
+async def simulate_work(scale=1.0):
+    """Ждёт заданную задержку, возвращает True, если вызов должен завершиться ошибкой"""
+    delay = (LATENCY + random.random() * LATENCY_JITTER) * scale
+    if delay > 0:
+        await asyncio.sleep(delay)
+    return random.random() < FAILURE_RATE
+
+
+def group_status(group_id):
+    if group_id not in ready_at:
+        return "NOT_FOUND"
+    if ready_at[group_id] <= time.monotonic():
+        return "OK"
+    return "NOT_READY"
+
+
+async def send_ready_callback(group_id):
+    await asyncio.sleep(TRAIN_SECONDS)
+    body = json.dumps({"group_id": group_id,
+                      "service_name": SERVICE_NAME}).encode()
+    signature = HMAC(CALLBACK_SECRET.encode(), body, sha256).hexdigest()
+    async with httpx.AsyncClient() as client:
+        await client.post(CALLBACK_URL, content=body, headers={
+            "Content-Type": "application/json", "X-Signature": signature})
+
+
+@app.post("/add_group")
+async def add_group(data: AddGroupModel):
+    '''Запоминает группу, через STUB_TRAIN_SECONDS секунд она станет готовой'''
+    requests_count["add_group"] += 1
+    if await simulate_work():
+        return {"result": "ERROR"}
+    ready_at[data.group_id] = time.monotonic() + TRAIN_SECONDS
+    if CALLBACK_URL:
+        task = asyncio.create_task(send_ready_callback(data.group_id))
+        callback_tasks.add(task)
+        task.add_done_callback(callback_tasks.discard)
+    return {"result": "OK"}
+
+
+@app.post("/add_group_chunk")
+async def add_group_chunk(data: AddGroupChunkModel):
+    '''Часть корпуса группы, после последней части группа начинает "обучаться"'''
+    requests_count["add_group_chunk"] += 1
+    if await simulate_work():
+        return {"result": "ERROR"}
+    if data.last:
+        ready_at[data.group_id] = time.monotonic() + TRAIN_SECONDS
+        if CALLBACK_URL:
+            task = asyncio.create_task(send_ready_callback(data.group_id))
+            callback_tasks.add(task)
+            task.add_done_callback(callback_tasks.discard)
+    return {"result": "OK"}
+
+
+@app.post("/generate")
+async def generate(data: GenerateModel):
+    '''Возвращает подсказку, дополненную фиксированным текстом'''
+    requests_count["generate"] += 1
+    if await simulate_work():
+        return {"result": "ERROR"}
+    if group_status(data.group_id) != "OK":
+        return {"result": "ERROR"}
+    return {"result": f"{data.hint} - stub text for group {data.group_id}"}
+
+
+@app.post("/generate_stream")
+async def generate_stream(data: GenerateModel):
+    '''Тот же текст, что и /generate, но по словам в NDJSON с задержкой STUB_TOKEN_DELAY'''
+    requests_count["generate_stream"] += 1
+
+    async def lines():
+        if await simulate_work() or group_status(data.group_id) != "OK":
+            yield json.dumps({"result": "ERROR"}) + "\n"
+            return
+        for word in f"{data.hint} - stub text for group {data.group_id}".split(" "):
+            await asyncio.sleep(TOKEN_DELAY)
+            yield json.dumps({"result": word + " "}, ensure_ascii=False) + "\n"
+
+    return StreamingResponse(lines(), media_type="application/x-ndjson")
+
+
+@app.get("/check_status")
+async def check_status(group_id: int):
+    '''Готовность одной группы'''
+    requests_count["check_status"] += 1
+    if await simulate_work(0.1):
+        return {"result": "ERROR"}
+    return {"result": group_status(group_id)}
+
+
+if SUPPORTS_BATCH:
+    @app.post("/check_statuses")
+    async def check_statuses(data: CheckStatusesModel):
+        '''Готовность пачки групп одним запросом'''
+        requests_count["check_statuses"] += 1
+        if await simulate_work(0.1):
+            return {"result": "ERROR"}
+        return {"result": {str(group_id): group_status(group_id) for group_id in data.group_ids}}
+
+
+@app.get("/health")
+async def health():
+    '''Проверка здоровья для балансировщика основного сервиса'''
+    return {"result": "OK"}
+
+
+@app.get("/stats")
+async def stats():
+    '''Количество запросов к каждой ручке с момента старта или последнего сброса'''
+    return {"result": dict(requests_count)}
+
+
+@app.post("/reset_stats")
+async def reset_stats():
+    '''Сбрасывает счётчики запросов'''
+    requests_count.clear()
+    return {"result": "OK"}